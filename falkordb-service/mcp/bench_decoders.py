@@ -0,0 +1,79 @@
+"""
+Порівняння verbose- та compact-декодера відповіді GRAPH.QUERY на синтетичній
+відповіді у 100k рядків (без підключення до FalkorDB).
+
+Запуск: python bench_decoders.py [кількість_рядків]
+"""
+import sys
+import time
+
+from main import format_falkordb_results, format_compact_results, format_falkordb_page, format_compact_page
+
+SCHEMA = {
+    "labels": ["Session", "Entity"],
+    "relationship_types": ["INVOLVES"],
+    "property_keys": ["id", "name", "description", "type"]
+}
+
+
+def verbose_reply(rows):
+    """Відповідь у форматі звичайного GRAPH.QUERY (як її повертає redis.asyncio)."""
+    data = []
+    for i in range(rows):
+        node = [
+            [b'id', i],
+            [b'labels', [b'Entity']],
+            [b'properties', [
+                [b'id', f"entity_{i}".encode()],
+                [b'name', f"Entity {i}".encode()],
+                [b'description', b'Synthetic entity used by the decoder benchmark'],
+                [b'type', b'Concept']
+            ]]
+        ]
+        edge = [[b'id', i], [b'type', b'INVOLVES'], [b'src_node', 0], [b'dest_node', i], [b'properties', []]]
+        data.append([node, edge, f"entity_{i}".encode(), i, b'0.5'])
+    return [[b'e', b'r', b'e.id', b'rank', b'score'], data, [b'Cached execution: 1']]
+
+
+def compact_reply(rows):
+    """Та сама відповідь у форматі GRAPH.QUERY ... --compact."""
+    data = []
+    for i in range(rows):
+        node = [8, [i, [1], [
+            [0, 2, f"entity_{i}".encode()],
+            [1, 2, f"Entity {i}".encode()],
+            [2, 2, b'Synthetic entity used by the decoder benchmark'],
+            [3, 2, b'Concept']
+        ]]]
+        edge = [7, [i, 0, 0, i, []]]
+        data.append([node, edge, [2, f"entity_{i}".encode()], [3, i], [5, b'0.5']])
+    headers = [[1, b'e'], [1, b'r'], [1, b'e.id'], [1, b'rank'], [1, b'score']]
+    return [headers, data, [b'Cached execution: 1']]
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:10.1f} ms")
+    return result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    verbose = verbose_reply(rows)
+    compact = compact_reply(rows)
+    print(f"Synthetic reply: {rows} rows x 5 columns")
+
+    full_verbose = timed("verbose: format_falkordb_results", lambda: format_falkordb_results(verbose))
+    full_compact = timed("compact: format_compact_results", lambda: format_compact_results(compact, SCHEMA))
+    timed("verbose: first page", lambda: format_falkordb_page(verbose))
+    timed("compact: first page", lambda: format_compact_page(compact, SCHEMA))
+
+    # Вузли та зв'язки мають збігатися; скаляри compact повертає з рідними типами
+    assert [row["e"] for row in full_verbose] == [row["e"] for row in full_compact]
+    assert [row["r"] for row in full_verbose] == [row["r"] for row in full_compact]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,18 @@
 import os
+import re
+import asyncio
+import math
+import functools
+import time as time_module
+import uuid
+import datetime
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import logging
 import json
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 from fastapi import FastAPI, Request
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from starlette.responses import JSONResponse
@@ -15,44 +26,135 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mcp-falkordb")
 
+@asynccontextmanager
+async def lifespan(app):
+    """Пул з'єднань FalkorDB належить життєвому циклу застосунку."""
+    global db_client
+    try:
+        r = await get_db()
+        logger.info(f"FalkorDB connected successfully at startup!")
+        report = await provision_id_indexes(r, DEFAULT_INDEXED_LABELS)
+        logger.info(f"id indexes: existing={report['existing']}, created={report['created']}")
+    except Exception as e:
+        logger.error(f"FalkorDB startup initialisation failed: {e}")
+    yield
+    if db_client is not None:
+        await db_client.connection_pool.disconnect()
+        db_client = None
+
 # Ініціалізація FastAPI
-app = FastAPI(title="FalkorDB MCP Server (Async)", version="0.1.0")
+app = FastAPI(title="FalkorDB MCP Server (Async)", version="0.1.0", lifespan=lifespan)
 
 # Дозволяємо будь-які хости (актуально для роботи всередині Docker та SSE)
 app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
 
 # Глобальні змінні бази даних
 db_client = None
+FALKORDB_HOST = os.getenv("FALKORDB_HOST", "falkordb")
+FALKORDB_PORT = int(os.getenv("FALKORDB_PORT", "6379"))
+FALKORDB_MAX_CONNECTIONS = int(os.getenv("FALKORDB_MAX_CONNECTIONS", "32"))
+FALKORDB_POOL_TIMEOUT = float(os.getenv("FALKORDB_POOL_TIMEOUT", "10"))
+FALKORDB_SOCKET_TIMEOUT = float(os.getenv("FALKORDB_SOCKET_TIMEOUT", "60"))
+FALKORDB_CONNECT_TIMEOUT = float(os.getenv("FALKORDB_CONNECT_TIMEOUT", "5"))
+FALKORDB_HEALTH_CHECK_INTERVAL = int(os.getenv("FALKORDB_HEALTH_CHECK_INTERVAL", "30"))
+FALKORDB_RETRIES = int(os.getenv("FALKORDB_RETRIES", "3"))
 GRAPH_NAME = os.getenv("GRAPH_NAME", "Grynya")
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+QUERY_TEMPLATE_CACHE_SIZE = int(os.getenv("QUERY_TEMPLATE_CACHE_SIZE", "256"))
+QUERY_GRAPH_TIMEOUT = float(os.getenv("QUERY_GRAPH_TIMEOUT", "30"))
+QUERY_FANOUT_CONCURRENCY = int(os.getenv("QUERY_FANOUT_CONCURRENCY", "4"))
+
+# Мітки, для яких індекс на id створюється при старті (решта — ліниво в add_node)
+DEFAULT_INDEXED_LABELS = ["Session", "Request", "Response", "Feedback", "Analysis", "Entity", "Year", "Day", "Research"]
+indexed_labels = set()
+ID_LABEL_CACHE_SIZE = int(os.getenv("ID_LABEL_CACHE_SIZE", "50000"))
+
+# Посторінкова видача query_graph
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", "200"))
+QUERY_PAGE_MAX_BYTES = int(os.getenv("QUERY_PAGE_MAX_BYTES", "262144"))
+CURSOR_TTL = float(os.getenv("CURSOR_TTL", "600"))
+MAX_CURSORS = int(os.getenv("MAX_CURSORS", "64"))
+result_cursors = OrderedDict()
+
+# Декодер відповіді query_graph: "verbose" (GRAPH.QUERY) або "compact" (GRAPH.QUERY ... --compact)
+RESULT_DECODER = os.getenv("RESULT_DECODER", "verbose")
+graph_schemas = {}
+
+# Кеш результатів read-only запитів query_graph (TTL + LRU), скидається при записі в граф
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "30"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "10000"))
+graph_generations = {}
+# Лічильники змін графів у Redis (переживають перезапуск; ключ GRAPH_VERSION_KEY + назва графа)
+GRAPH_VERSION_KEY = os.getenv("GRAPH_VERSION_KEY", "grynya:graph_version:")
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    """BlockingConnectionPool, що рахує очікування вільного з'єднання для /health."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.acquire_errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def get_connection(self, *args, **kwargs):
+        start = time_module.monotonic()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except Exception:
+            self.acquire_errors += 1
+            raise
+        waited = time_module.monotonic() - start
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return connection
+
+    def stats(self):
+        in_use = len(getattr(self, "_in_use_connections", ()))
+        idle = len(getattr(self, "_available_connections", ()))
+        return {
+            "max_connections": self.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "saturation": round(in_use / self.max_connections, 4) if self.max_connections else 0.0,
+            "acquired": self.acquired,
+            "acquire_errors": self.acquire_errors,
+            "avg_wait_ms": round(self.wait_total / self.acquired * 1000, 3) if self.acquired else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 3)
+        }
+
+def create_db_client():
+    """Клієнт FalkorDB поверх явно налаштованого пулу з повтором при ConnectionError."""
+    pool = MeteredConnectionPool(
+        host=FALKORDB_HOST,
+        port=FALKORDB_PORT,
+        max_connections=FALKORDB_MAX_CONNECTIONS,
+        timeout=FALKORDB_POOL_TIMEOUT,
+        socket_timeout=FALKORDB_SOCKET_TIMEOUT,
+        socket_connect_timeout=FALKORDB_CONNECT_TIMEOUT,
+        health_check_interval=FALKORDB_HEALTH_CHECK_INTERVAL,
+        retry=Retry(ExponentialBackoff(cap=2.0, base=0.1), FALKORDB_RETRIES),
+        retry_on_error=[redis.ConnectionError],
+        decode_responses=False
+    )
+    return redis.Redis(connection_pool=pool)
 
 async def get_db():
     global db_client
     if db_client is None:
-        db_host = os.getenv("FALKORDB_HOST", "localhost")
-        if os.getenv("FALKORDB_PORT", None) is None:
-            db_host = "falkordb"
-        db_port = int(os.getenv("FALKORDB_PORT", "6379"))
+        client = create_db_client()
         try:
-            db_client = redis.Redis(host=db_host, port=db_port, decode_responses=False)
-            await db_client.ping()
-            logger.info("FalkorDB (redis.asyncio) connected lazily!")
+            await client.ping()
         except Exception as e:
-            logger.error(f"FalkorDB lazy connection failed: {e}")
+            logger.error(f"FalkorDB connection failed: {e}")
+            await client.connection_pool.disconnect()
             raise e
+        db_client = client
+        logger.info(f"FalkorDB (redis.asyncio) connected at {FALKORDB_HOST}:{FALKORDB_PORT}")
     return db_client
 
-@app.on_event("startup")
-async def startup_event():
-    global db_client
-    db_host = os.getenv("FALKORDB_HOST", "falkordb")
-    db_port = int(os.getenv("FALKORDB_PORT", "6379"))
-    try:
-        db_client = redis.Redis(host=db_host, port=db_port, decode_responses=False)
-        await db_client.ping()
-        logger.info(f"FalkorDB connected successfully at startup!")
-    except Exception as e:
-        logger.error(f"FalkorDB connection failed at startup: {e}")
-
 from mcp.server.fastmcp import FastMCP
 
 # Ініціалізація MCP Сервера
@@ -62,7 +164,12 @@ mcp = FastMCP("grynya-falkordb-mcp", host="0.0.0.0")
 async def health():
     return JSONResponse(content={
         "status": "ok", 
-        "falkordb_connected": db_client is not None
+        "falkordb_connected": db_client is not None,
+        "pool": db_client.connection_pool.stats() if db_client is not None else None,
+        "result_decoder": RESULT_DECODER,
+        "query_templates": query_template.cache_info()._asdict(),
+        "id_label_cache": label_cache.stats(),
+        "result_cache": result_cache.stats()
     })
 
 # Mount the MCP SSE application
@@ -75,6 +182,444 @@ def e_str(value):
     escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
     return f'"{escaped}"'
 
+_IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+def cypher_ident(name):
+    """Перевіряє мітку або тип зв'язку — їх не можна передати параметром."""
+    if not name or not _IDENT_RE.match(str(name)):
+        raise ValueError(f"Invalid label or relationship type: {name!r}")
+    return str(name)
+
+def cypher_value(value):
+    """Серіалізує значення у літерал Cypher для заголовка параметрів CYPHER."""
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float) and math.isfinite(value):
+        return repr(value)
+    if isinstance(value, dict):
+        items = ", ".join(
+            f"`{str(k).replace('`', '``')}`: {cypher_value(v)}" for k, v in value.items()
+        )
+        return f"{{{items}}}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(cypher_value(v) for v in value) + "]"
+    return e_str(value)
+
+def params_header(params):
+    """Формує префікс `CYPHER name=value ...` для параметризованого запиту."""
+    if not params:
+        return ""
+    return "CYPHER " + " ".join(f"{k}={cypher_value(v)}" for k, v in params.items()) + " "
+
+def prop_map(data, skip=()):
+    """Властивості вузла/зв'язку як рядки — так само, як їх зберігає e_str."""
+    return {k: "" if v is None else str(v) for k, v in data.items() if k not in skip}
+
+# Шаблони запитів інструментів запису. Значення передаються лише параметрами
+# (CYPHER name=value ...), тож текст запиту однаковий для однакових за формою
+# викликів і FalkorDB повторно використовує закешований план виконання.
+# Властивості йдуть однією мапою ($props), тому набір ключів не змінює шаблон.
+QUERY_TEMPLATES = {
+    "session": "MERGE (s:Session {{id: $id}}) SET s += $props",
+    "year": "MERGE (y:Year {{value: $value, id: $id, name: $name}})",
+    "day": "MERGE (d:Day {{date: $date, id: $id, name: $name}})",
+    "month": "MATCH (y:Year {{id: $year_id}}), (d:Day {{id: $day_id}}) MERGE (y)-[:MONTH {{number: $number}}]->(d)",
+    "node": "MERGE (n:{label} {{id: $id}}) SET n += $props",
+    "happened_at": "MATCH (n{source} {{id: $id}}), (d:Day {{id: $day_id}}) MERGE (n)-[:HAPPENED_AT {{time: $time}}]->(d)",
+    "link": (
+        "MATCH (s{source} {{id: $source_id}}), (t{target} {{id: $target_id}}) "
+        "MERGE (s)-[r:{rel_type}]->(t) SET r += $props RETURN labels(s)[0], labels(t)[0]"
+    ),
+    "clear_last_event": "MATCH (s:Session {{id: $session_id}})-[rel:LAST_EVENT]->() DELETE rel",
+    "set_last_event": (
+        "MATCH (s:Session {{id: $session_id}}), (last{target} {{id: $event_id}}) "
+        "MERGE (s)-[:LAST_EVENT]->(last) RETURN labels(last)[0]"
+    ),
+    "delete_node": "MATCH (n{source} {{id: $id}}) DETACH DELETE n",
+    "delete_link": "MATCH (s{source} {{id: $source_id}})-[r:{rel_type}]->(t{target} {{id: $target_id}}) DELETE r",
+    "batch_nodes": "UNWIND $rows AS row MERGE (n:{label} {{id: row.id}}) SET n += row.props RETURN row.idx",
+    "batch_nodes_day": (
+        "UNWIND $rows AS row MERGE (n:{label} {{id: row.id}}) SET n += row.props "
+        "WITH n, row OPTIONAL MATCH (d:Day {{id: $day_id}}) "
+        "FOREACH (_ IN CASE WHEN d IS NULL THEN [] ELSE [1] END | "
+        "MERGE (n)-[:HAPPENED_AT {{time: $time}}]->(d)) "
+        "RETURN row.idx, d IS NOT NULL"
+    ),
+    "batch_links": (
+        "UNWIND $rows AS row "
+        "MATCH (s{source} {{id: row.source_id}}), (t{target} {{id: row.target_id}}) "
+        "MERGE (s)-[r:{rel_type}]->(t) SET r += row.props "
+        "RETURN DISTINCT row.idx, labels(s)[0], labels(t)[0]"
+    ),
+    "id_indexes": (
+        "CALL db.indexes() YIELD label, properties, entitytype "
+        "WHERE entitytype = 'NODE' AND 'id' IN properties RETURN label"
+    ),
+    "create_id_index": "CREATE INDEX FOR (n:{label}) ON (n.id)",
+}
+
+@functools.lru_cache(maxsize=QUERY_TEMPLATE_CACHE_SIZE)
+def query_template(name, label=None, rel_type=None, source_label=None, target_label=None):
+    """
+    Рендерить шаблон запиту; результат кешується за (шаблон, мітка, тип зв'язку,
+    мітки джерела/цілі). Мітки джерела/цілі перетворюють MATCH на пошук по індексу.
+    """
+    return QUERY_TEMPLATES[name].format(
+        label=cypher_ident(label) if label else "",
+        rel_type=cypher_ident(rel_type) if rel_type else "",
+        source=f":{cypher_ident(source_label)}" if source_label else "",
+        target=f":{cypher_ident(target_label)}" if target_label else ""
+    )
+
+def render_query(name, params, label=None, rel_type=None, source_label=None, target_label=None):
+    """Повний текст запиту: заголовок параметрів + закешований шаблон."""
+    return params_header(params) + query_template(name, label, rel_type, source_label, target_label)
+
+async def graph_query(r, query, graph=None, compact=False, read_only=False):
+    """
+    Виконує запит у вказаному графі (за замовчуванням GRAPH_NAME).
+    read_only=True надсилає GRAPH.RO_QUERY; будь-який GRAPH.QUERY вважається записом:
+    скидає кеш результатів цього графа і в тому ж pipeline збільшує його лічильник змін.
+    Лічильник збільшується й тоді, коли запис відхилено: INCR іде в тому ж pipeline,
+    щоб не витрачати окремий round trip на кожен успішний запис.
+    Помилка запиту повертається як ResponseError від FalkorDB, без обгортки pipeline.
+    """
+    graph = graph or GRAPH_NAME
+    command = "GRAPH.RO_QUERY" if read_only else "GRAPH.QUERY"
+    args = (command, graph, query, "--compact") if compact else (command, graph, query)
+    if read_only:
+        return await r.execute_command(*args)
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.execute_command(*args)
+            pipe.incr(GRAPH_VERSION_KEY + graph)
+            res, _ = await pipe.execute(raise_on_error=False)
+        if isinstance(res, Exception):
+            raise res
+        return res
+    finally:
+        invalidate_graph(graph)
+
+_STRING_LITERAL_RE = re.compile(r"""('(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")""")
+_WRITE_CLAUSE_RE = re.compile(r"\b(CREATE|MERGE|SET|DELETE|REMOVE|DROP|LOAD\s+CSV)\b", re.IGNORECASE)
+_UNKNOWN_PROCEDURE_RE = re.compile(
+    r"\bCALL\s+(?!(db\.labels|db\.relationshipTypes|db\.propertyKeys|db\.indexes|db\.constraints"
+    r"|db\.idx\.\w+\.query\w*|dbms\.procedures|algo\.\w+)\s*\()",
+    re.IGNORECASE
+)
+
+def normalise_query(query):
+    """Стискає пробіли поза рядковими літералами — ключ кешу результатів."""
+    parts = _STRING_LITERAL_RE.split(query.strip())
+    return "".join(p if i % 2 else re.sub(r"\s+", " ", p) for i, p in enumerate(parts))
+
+def is_read_only(query):
+    """Грубе визначення read-only Cypher: без клауз запису та без невідомих процедур."""
+    code = " ".join(_STRING_LITERAL_RE.split(query)[::2])
+    return not _WRITE_CLAUSE_RE.search(code) and not _UNKNOWN_PROCEDURE_RE.search(code)
+
+class ResultCache:
+    """
+    TTL + LRU кеш сирих відповідей read-only запитів за (граф, нормалізований запит, декодер).
+    Кожен запис пам'ятає лічильник змін графа з Redis (GRAPH_VERSION_KEY), з яким його прочитано:
+    запис іншого процесу (провайдер з GRAPH_BACKEND=direct або інший екземпляр сервісу)
+    змінює лічильник, і запис перестає видаватись, хоча локальний invalidate_graph його не бачив.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, version=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time_module.monotonic() or entry[2] != version:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, res, version=None):
+        if not self.enabled:
+            return
+        if len(res) >= 3 and isinstance(res[1], list) and len(res[1]) > RESULT_CACHE_MAX_ROWS:
+            return
+        self.entries[key] = (time_module.monotonic() + self.ttl, res, version)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, graph):
+        for key in [k for k in self.entries if k[0] == graph]:
+            del self.entries[key]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+def invalidate_graph(graph):
+    """Позначає граф зміненим: скидає кеш результатів і збільшує його лічильник змін."""
+    graph_generations[graph] = graph_generations.get(graph, 0) + 1
+    result_cache.invalidate(graph)
+
+# Відповідь без колонок і рядків (читання з графа, якого ще не існує)
+EMPTY_RESULT = [[], [], []]
+
+async def read_graph(r, query, graph, compact=False):
+    """
+    Запит query_graph: read-only Cypher іде через GRAPH.RO_QUERY і кешується,
+    решта — через GRAPH.QUERY. Якщо FalkorDB відхиляє RO_QUERY як запис, запит повторюється
+    через GRAPH.QUERY; читання з неіснуючого графа повертає EMPTY_RESULT.
+    """
+    if not is_read_only(query):
+        return await graph_query(r, query, graph, compact)
+    key = (graph, normalise_query(query), compact)
+    # Один GET лічильника замість повного запиту; без нього кеш не бачив би записів інших процесів
+    version = await r.get(GRAPH_VERSION_KEY + graph) if result_cache.enabled else None
+    res = result_cache.get(key, version)
+    if res is not None:
+        return res
+    generation = graph_generations.get(graph, 0)
+    try:
+        res = await graph_query(r, query, graph, compact, read_only=True)
+    except redis.ResponseError as e:
+        # Графа ще немає: читати нічого, а GRAPH.QUERY створив би граф і збільшив його лічильник змін
+        if "empty key" in str(e):
+            return EMPTY_RESULT
+        # RO_QUERY відхиляє запити з записом, які is_read_only не розпізнав
+        if "read-only" not in str(e):
+            raise
+        return await graph_query(r, query, graph, compact)
+    # Не кешуємо відповідь, якщо граф змінився, поки запит виконувався
+    if graph_generations.get(graph, 0) == generation:
+        result_cache.put(key, res, version)
+    return res
+
+class IdLabelCache:
+    """
+    Обмежений LRU id → мітка вузла поточного графа. Дозволяє перетворити
+    MATCH (n {id: ...}) без мітки на пошук по індексу MATCH (n:Label {id: ...}).
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.labels = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, node_id):
+        label = self.labels.get(node_id)
+        if label is None:
+            self.misses += 1
+            return None
+        self.labels.move_to_end(node_id)
+        self.hits += 1
+        return label
+
+    def put(self, node_id, label):
+        if not node_id or not isinstance(label, str) or not _IDENT_RE.match(label):
+            return
+        self.labels[str(node_id)] = label
+        self.labels.move_to_end(str(node_id))
+        while len(self.labels) > self.maxsize:
+            self.labels.popitem(last=False)
+
+    def discard(self, node_id):
+        self.labels.pop(node_id, None)
+
+    def remember_nodes(self, rows):
+        """Запам'ятовує мітки вузлів з відформатованих результатів query_graph."""
+        for row in rows:
+            for val in row.values():
+                if isinstance(val, dict) and val.get("labels") and isinstance(val.get("properties"), dict):
+                    self.put(val["properties"].get("id"), val["labels"][0])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.labels),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_fallbacks": self.stale,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+label_cache = IdLabelCache(ID_LABEL_CACHE_SIZE)
+
+def has_rows(res):
+    return len(res) >= 3 and bool(res[1])
+
+def query_stat(res, name):
+    """Числове значення зі статистики відповіді (наприклад 'Nodes deleted')."""
+    for line in decode_falkor(res[-1]) if res else []:
+        if isinstance(line, str) and line.startswith(name + ":"):
+            return float(line.split(":", 1)[1].split()[0])
+    return 0
+
+async def run_resolved(r, name, params, rel_type=None, source_id=None, target_id=None,
+                       source_label=None, target_label=None, matched=has_rows):
+    """
+    Виконує шаблон, підставляючи мітки source/target з label_cache, якщо їх не передано.
+    Якщо запит з кешованою міткою нічого не знайшов (мітка застаріла) — вилучає
+    ці id з кешу та повторює запит лише з явно переданими мітками.
+    Повертає (текст запиту, відповідь FalkorDB).
+    """
+    resolved_source = source_label or (label_cache.get(source_id) if source_id else None)
+    resolved_target = target_label or (label_cache.get(target_id) if target_id else None)
+    q = render_query(name, params, rel_type=rel_type,
+                     source_label=resolved_source, target_label=resolved_target)
+    res = await graph_query(r, q)
+    from_cache = [node_id for node_id, explicit, resolved in (
+        (source_id, source_label, resolved_source), (target_id, target_label, resolved_target)
+    ) if resolved and not explicit]
+    if from_cache and not matched(res):
+        label_cache.stale += 1
+        for node_id in from_cache:
+            label_cache.discard(node_id)
+        q = render_query(name, params, rel_type=rel_type,
+                         source_label=source_label, target_label=target_label)
+        res = await graph_query(r, q)
+    return q, res
+
+@functools.lru_cache(maxsize=QUERY_TEMPLATE_CACHE_SIZE)
+def add_node_template(node_type, rel_groups, link_day, merge_node):
+    """
+    Компілює вузол, HAPPENED_AT і всі групи relations в один Cypher-запит через WITH-ланцюжок.
+    rel_groups — кортеж (тип, мітка цілі); кожна група читає свій параметр $rels_<i>.
+    Повертає колонки: day_linked (якщо link_day) та linked — список [idx, мітка цілі].
+    """
+    label = cypher_ident(node_type)
+    if merge_node:
+        parts = [f"MERGE (n:{label} {{id: $id}}) SET n += $props"]
+    else:
+        parts = [f"MATCH (n:{label} {{id: $id}})"]
+    carried = ["n"]
+    if link_day:
+        parts.append(
+            "WITH n OPTIONAL MATCH (d:Day {id: $day_id}) "
+            "FOREACH (_ IN CASE WHEN d IS NULL THEN [] ELSE [1] END | "
+            "MERGE (n)-[:HAPPENED_AT {time: $time}]->(d)) "
+            "WITH n, d IS NOT NULL AS day_linked"
+        )
+        carried.append("day_linked")
+    for i, (rel_type, target_label) in enumerate(rel_groups):
+        target = f":{cypher_ident(target_label)}" if target_label else ""
+        parts.append(
+            f"WITH {', '.join(carried)} UNWIND $rels_{i} AS rel "
+            f"OPTIONAL MATCH (t{target} {{id: rel.target_id}}) "
+            "FOREACH (_ IN CASE WHEN t IS NULL THEN [] ELSE [1] END | "
+            f"MERGE (n)-[r:{cypher_ident(rel_type)}]->(t) SET r += rel.props) "
+            f"WITH {', '.join(carried)}, "
+            f"collect(CASE WHEN t IS NULL THEN NULL ELSE [rel.idx, labels(t)[0]] END) AS linked_{i}"
+        )
+        carried.append(f"linked_{i}")
+    linked = " + ".join(f"linked_{i}" for i in range(len(rel_groups))) or "[]"
+    parts.append(f"RETURN {'day_linked' if link_day else 'false'}, {linked}")
+    return " ".join(parts)
+
+def render_add_node(node_type, params, groups, link_day, merge_node):
+    """Текст запиту add_node: groups — {(тип, мітка цілі): [рядки relations]}."""
+    params = dict(params)
+    for i, rows in enumerate(groups.values()):
+        params[f"rels_{i}"] = rows
+    return params_header(params) + add_node_template(node_type, tuple(groups), link_day, merge_node)
+
+def unpack_add_node_result(res, link_day):
+    """(day_linked, {idx relation: мітка цілі}) з compact-відповіді add_node_template."""
+    if not has_rows(res):
+        return False, {}
+    day_cell, linked_cell = res[1][0]
+    linked = compact_value(None, *linked_cell)
+    return (compact_value(None, *day_cell) if link_day else False), {idx: label for idx, label in linked}
+
+async def provision_id_indexes(r, labels):
+    """
+    Створює range-індекси на id для міток, які ще не мають індексу
+    (зокрема коли графа ще не існує — тоді його створює перший CREATE INDEX).
+    Повертає {"existing": [...], "created": [...], "errors": {label: message}}.
+    """
+    try:
+        res = await graph_query(r, query_template("id_indexes"), read_only=True)
+        existing = {row[0] for row in decode_falkor(res)[1]} if len(res) >= 3 else set()
+    except redis.ResponseError as e:
+        # Графа ще немає (нове розгортання): індексів теж немає, CREATE INDEX створить граф
+        if "empty key" not in str(e):
+            raise
+        existing = set()
+    indexed_labels.update(existing)
+    report = {"existing": sorted(existing), "created": [], "errors": {}}
+    for label in dict.fromkeys(labels):
+        if label in existing:
+            continue
+        try:
+            await graph_query(r, query_template("create_id_index", label=label))
+            report["created"].append(label)
+            indexed_labels.add(label)
+        except Exception as e:
+            if "already indexed" in str(e):
+                indexed_labels.add(label)
+            else:
+                report["errors"][label] = str(e)
+    return report
+
+async def ensure_id_index(r, label):
+    """Лінивий варіант provision_id_indexes для однієї мітки; помилки лише логуються."""
+    if label in indexed_labels:
+        return
+    try:
+        await provision_id_indexes(r, [label])
+    except Exception as e:
+        logger.error(f"Failed to ensure id index for {label}: {e}")
+
+async def run_unwind_batches(r, query, rows, chunk_size=None, params=None):
+    """
+    Виконує `UNWIND $rows ...` пачками по chunk_size рядків.
+    Запит має повертати row.idx першою колонкою.
+    Повертає ({idx: інші колонки}, {idx: повідомлення про помилку}, кількість запитів).
+    """
+    size = chunk_size or BATCH_CHUNK_SIZE
+    size = max(1, int(size))
+    returned, failed, sent = {}, {}, 0
+    for start in range(0, len(rows), size):
+        chunk = rows[start:start + size]
+        chunk_params = dict(params or {})
+        chunk_params["rows"] = chunk
+        sent += 1
+        try:
+            res = await graph_query(r, params_header(chunk_params) + query)
+        except Exception as e:
+            for row in chunk:
+                failed[row["idx"]] = str(e)
+            continue
+        data = decode_falkor(res)[1] if len(res) >= 3 else []
+        for values in data:
+            returned[values[0]] = values[1:]
+    return returned, failed, sent
+
 def decode_falkor(item):
     if isinstance(item, bytes):
         try:
@@ -101,92 +646,333 @@ def format_falkordb_results(res):
         return []
 
     for row in data:
-        row_dict = {}
-        for idx, col_name in enumerate(headers):
-            val = row[idx]
-            
-            # check if it's a node or edge
-            is_graph_entity = False
-            if isinstance(val, list) and len(val) > 0 and isinstance(val[0], list) and len(val[0]) == 2 and val[0][0] == 'id':
-                is_graph_entity = True
-                
-            if is_graph_entity:
-                obj_dict = {}
-                for prop_pair in val:
-                    if isinstance(prop_pair, list) and len(prop_pair) == 2:
-                        k, v = prop_pair
-                        if k == 'properties' and isinstance(v, list):
-                            props_dict = {}
-                            for p in v:
-                                if isinstance(p, list) and len(p) == 2:
-                                    props_dict[p[0]] = p[1]
-                            obj_dict[k] = props_dict
-                        else:
-                            obj_dict[k] = v
-                row_dict[col_name] = obj_dict
-            else:
-                row_dict[col_name] = val
-        formatted_data.append(row_dict)
+        formatted_data.append(format_falkordb_row(headers, row))
     return formatted_data
 
+def format_falkordb_row(headers, row):
+    row_dict = {}
+    for idx, col_name in enumerate(headers):
+        val = row[idx]
+        
+        # check if it's a node or edge
+        is_graph_entity = False
+        if isinstance(val, list) and len(val) > 0 and isinstance(val[0], list) and len(val[0]) == 2 and val[0][0] == 'id':
+            is_graph_entity = True
+            
+        if is_graph_entity:
+            obj_dict = {}
+            for prop_pair in val:
+                if isinstance(prop_pair, list) and len(prop_pair) == 2:
+                    k, v = prop_pair
+                    if k == 'properties' and isinstance(v, list):
+                        props_dict = {}
+                        for p in v:
+                            if isinstance(p, list) and len(p) == 2:
+                                props_dict[p[0]] = p[1]
+                        obj_dict[k] = props_dict
+                    else:
+                        obj_dict[k] = v
+            row_dict[col_name] = obj_dict
+        else:
+            row_dict[col_name] = val
+    return row_dict
+
+def format_falkordb_page(res, offset=0, page_size=None, max_bytes=None):
+    """
+    Декодує та форматує лише рядки сирої відповіді, починаючи з offset:
+    не більше page_size рядків і не більше max_bytes JSON (мінімум один рядок).
+    Повертає (рядки сторінки, offset наступної сторінки або None, всього рядків).
+    """
+    if len(res) < 3 or not isinstance(res[0], list) or not isinstance(res[1], list):
+        return [], None, 0
+    headers = decode_falkor(res[0])
+    return paginate(res[1], offset, page_size, max_bytes,
+                    lambda row: format_falkordb_row(headers, decode_falkor(row)))
+
+def paginate(rows, offset, page_size, max_bytes, to_dict):
+    page_size = max(1, page_size or QUERY_PAGE_SIZE)
+    max_bytes = max_bytes or QUERY_PAGE_MAX_BYTES
+    page, size, pos = [], 0, offset
+    while pos < len(rows) and len(page) < page_size:
+        row = to_dict(rows[pos])
+        row_bytes = len(json.dumps(row))
+        if page and size + row_bytes > max_bytes:
+            break
+        page.append(row)
+        size += row_bytes
+        pos += 1
+    return page, (pos if pos < len(rows) else None), len(rows)
+
+# --- Compact-декодер (GRAPH.QUERY ... --compact) ---
+# Кожна клітинка — [тип, значення]; мітки, типи зв'язків і ключі властивостей
+# приходять як числові id, які розкриваються через кеш схеми графа (graph_schemas).
+
+COMPACT_NULL, COMPACT_STRING, COMPACT_INTEGER, COMPACT_BOOLEAN, COMPACT_DOUBLE = 1, 2, 3, 4, 5
+COMPACT_ARRAY, COMPACT_EDGE, COMPACT_NODE, COMPACT_PATH, COMPACT_MAP = 6, 7, 8, 9, 10
+COMPACT_POINT, COMPACT_VECTORF32, COMPACT_DATETIME, COMPACT_DATE = 11, 12, 13, 14
+COMPACT_TIME, COMPACT_DURATION = 15, 16
+
+class UnknownSchemaId(LookupError):
+    """У compact-відповіді трапився id мітки/типу/ключа, якого немає в кеші схеми."""
+
+def schema_name(schema, kind, schema_id):
+    names = schema[kind]
+    if schema_id >= len(names):
+        raise UnknownSchemaId(f"Unknown {kind} id {schema_id}")
+    return names[schema_id]
+
+def compact_props(schema, props):
+    return {schema_name(schema, "property_keys", k): compact_value(schema, t, v) for k, t, v in props}
+
+def compact_value(schema, vtype, value):
+    """Розкриває одне значення compact-відповіді за один прохід."""
+    if vtype == COMPACT_STRING:
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+    if vtype == COMPACT_INTEGER or vtype == COMPACT_NULL:
+        return value
+    if vtype == COMPACT_NODE:
+        node_id, label_ids, props = value
+        return {
+            "id": node_id,
+            "labels": [schema_name(schema, "labels", i) for i in label_ids],
+            "properties": compact_props(schema, props)
+        }
+    if vtype == COMPACT_EDGE:
+        edge_id, type_id, src, dest, props = value
+        return {
+            "id": edge_id,
+            "type": schema_name(schema, "relationship_types", type_id),
+            "src_node": src,
+            "dest_node": dest,
+            "properties": compact_props(schema, props)
+        }
+    if vtype == COMPACT_DOUBLE:
+        number = float(value)
+        return number if math.isfinite(number) else value.decode()
+    if vtype == COMPACT_BOOLEAN:
+        return value == b'true'
+    if vtype == COMPACT_ARRAY:
+        return [compact_value(schema, t, v) for t, v in value]
+    if vtype == COMPACT_MAP:
+        items = iter(value)
+        return {k.decode('utf-8', 'replace'): compact_value(schema, *pair) for k, pair in zip(items, items)}
+    if vtype == COMPACT_PATH:
+        nodes, edges = value
+        return {"nodes": compact_value(schema, *nodes), "edges": compact_value(schema, *edges)}
+    if vtype == COMPACT_POINT:
+        return {"latitude": float(value[0]), "longitude": float(value[1])}
+    if vtype == COMPACT_VECTORF32:
+        return list(value)
+    if vtype == COMPACT_DATETIME:
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    if vtype == COMPACT_DATE:
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).date().isoformat()
+    if vtype == COMPACT_TIME:
+        seconds = value % 86400
+        return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    if vtype == COMPACT_DURATION:
+        return f"PT{value}S"
+    return decode_falkor(value)
+
+def compact_headers(res):
+    return [decode_falkor(h[1]) for h in res[0]]
+
+def format_compact_row(schema, headers, row):
+    return {name: compact_value(schema, *cell) for name, cell in zip(headers, row)}
+
+def format_compact_results(res, schema):
+    """Compact-аналог format_falkordb_results: декодує всю відповідь за один прохід."""
+    if len(res) < 3 or not isinstance(res[0], list) or not isinstance(res[1], list):
+        return []
+    headers = compact_headers(res)
+    return [format_compact_row(schema, headers, row) for row in res[1]]
+
+def format_compact_page(res, schema, offset=0, page_size=None, max_bytes=None):
+    """Compact-аналог format_falkordb_page."""
+    if len(res) < 3 or not isinstance(res[0], list) or not isinstance(res[1], list):
+        return [], None, 0
+    headers = compact_headers(res)
+    return paginate(res[1], offset, page_size, max_bytes,
+                    lambda row: format_compact_row(schema, headers, row))
+
+async def refresh_graph_schema(r, graph):
+    """Перечитує мітки, типи зв'язків і ключі властивостей графа (їх id = позиція у списку)."""
+    schema = {}
+    for kind, procedure in (("labels", "db.labels()"),
+                            ("relationship_types", "db.relationshipTypes()"),
+                            ("property_keys", "db.propertyKeys()")):
+        res = await graph_query(r, f"CALL {procedure}", graph, read_only=True)
+        schema[kind] = [row[0] for row in decode_falkor(res[1])]
+    graph_schemas[graph] = schema
+    return schema
+
+async def format_page(r, graph, res, compact, offset=0, page_size=None, max_bytes=None):
+    """Сторінка результату обраним декодером; невідомі id схеми оновлюють кеш один раз."""
+    if not compact:
+        return format_falkordb_page(res, offset, page_size, max_bytes)
+    if len(res) < 3 or not res[1]:
+        return [], None, 0
+    schema = graph_schemas.get(graph) or await refresh_graph_schema(r, graph)
+    try:
+        return format_compact_page(res, schema, offset, page_size, max_bytes)
+    except UnknownSchemaId:
+        schema = await refresh_graph_schema(r, graph)
+        return format_compact_page(res, schema, offset, page_size, max_bytes)
+
+def open_cursor(graph, res, offset, page_size, max_bytes, compact=False):
+    """Тримає сиру відповідь на сервері, щоб fetch_more декодував наступні сторінки."""
+    now = time_module.monotonic()
+    for token in [t for t, c in result_cursors.items() if c["expires"] <= now]:
+        del result_cursors[token]
+    while len(result_cursors) >= MAX_CURSORS:
+        result_cursors.popitem(last=False)
+    token = uuid.uuid4().hex
+    result_cursors[token] = {
+        "graph": graph,
+        "res": res,
+        "offset": offset,
+        "page_size": page_size,
+        "max_bytes": max_bytes,
+        "compact": compact,
+        "expires": now + CURSOR_TTL
+    }
+    return token
+
+async def paged_results(r, graph, res, compact, page_size=None, max_bytes=None):
+    """Перша сторінка результату + курсор (None, якщо інших сторінок немає)."""
+    page, next_offset, total = await format_page(r, graph, res, compact, 0, page_size, max_bytes)
+    if graph == GRAPH_NAME:
+        label_cache.remember_nodes(page)
+    cursor = None
+    if next_offset is not None:
+        cursor = open_cursor(graph, res, next_offset, page_size, max_bytes, compact)
+    return page, cursor, total
+
 
 @mcp.tool()
-async def query_graph(query: str, graphs: list = None) -> str:
+async def query_graph(query: str, graphs: list = None, page_size: int = None, max_bytes: int = None) -> str:
     """
-    Виконує Cypher запит до бази FalkorDB та повертає результат.
+    Виконує Cypher запит до бази FalkorDB та повертає першу сторінку результату.
+    Read-only запити йдуть через GRAPH.RO_QUERY і кешуються на RESULT_CACHE_TTL секунд
+    (кеш графа скидається будь-яким записом у нього).
     graphs: список назв графів для пошуку (наприклад ['Grynya', 'Cursa4']).
             Якщо не вказано — використовує поточний граф за замовчуванням (GRAPH_NAME env).
-            Якщо вказано кілька — виконує запит у кожному та об'єднує результати.
+            Якщо вказано кілька — виконує запит у всіх графах паралельно
+            (не більше QUERY_FANOUT_CONCURRENCY одночасно, таймаут QUERY_GRAPH_TIMEOUT
+            секунд на граф) та об'єднує результати.
+    page_size / max_bytes: ліміт рядків і байтів на сторінку (QUERY_PAGE_SIZE, QUERY_PAGE_MAX_BYTES).
+            Якщо результат більший — повертається "cursor" (для кількох графів — "cursors"),
+            наступні сторінки видає fetch_more(cursor).
+    Декодер відповіді обирається RESULT_DECODER ("verbose" або "compact").
     """
     target_graphs = graphs if graphs else [GRAPH_NAME]
+    compact = RESULT_DECODER == "compact"
     try:
         r = await get_db()
         if len(target_graphs) == 1:
-            res = await r.execute_command("GRAPH.QUERY", target_graphs[0], query)
-            formatted = format_falkordb_results(res)
-            return json.dumps({"status": "success", "graph": target_graphs[0], "results": formatted})
+            res = await read_graph(r, query, target_graphs[0], compact)
+            page, cursor, total = await paged_results(r, target_graphs[0], res, compact, page_size, max_bytes)
+            return json.dumps({
+                "status": "success",
+                "graph": target_graphs[0],
+                "results": page,
+                "total_rows": total,
+                "cursor": cursor
+            })
         
-        combined = {}
-        for graph_name in target_graphs:
-            try:
-                res = await r.execute_command("GRAPH.QUERY", graph_name, query)
-                combined[graph_name] = format_falkordb_results(res)
-            except Exception as e:
-                combined[graph_name] = {"error": str(e)}
-        return json.dumps({"status": "success", "multi_graph": True, "results": combined})
+        semaphore = asyncio.Semaphore(max(1, QUERY_FANOUT_CONCURRENCY))
+
+        async def query_one(graph_name):
+            async with semaphore:
+                try:
+                    res = await asyncio.wait_for(read_graph(r, query, graph_name, compact), QUERY_GRAPH_TIMEOUT)
+                    page, cursor, _ = await paged_results(r, graph_name, res, compact, page_size, max_bytes)
+                    return graph_name, page, cursor
+                except asyncio.TimeoutError:
+                    return graph_name, {"error": f"Query timed out after {QUERY_GRAPH_TIMEOUT}s"}, None
+                except Exception as e:
+                    return graph_name, {"error": str(e)}, None
+
+        combined, cursors = {}, {}
+        for graph_name, result, cursor in await asyncio.gather(*(query_one(g) for g in target_graphs)):
+            combined[graph_name] = result
+            if cursor:
+                cursors[graph_name] = cursor
+        return json.dumps({"status": "success", "multi_graph": True, "results": combined, "cursors": cursors})
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
 
 
+@mcp.tool()
+async def fetch_more(cursor: str, page_size: int = None, max_bytes: int = None) -> str:
+    """
+    Повертає наступну сторінку результату query_graph за курсором.
+    Курсор діє CURSOR_TTL секунд; у відповіді "cursor" — токен наступної сторінки або null.
+    """
+    state = result_cursors.pop(cursor, None)
+    if state is None or state["expires"] <= time_module.monotonic():
+        return json.dumps({"status": "error", "message": f"Cursor {cursor} not found or expired."})
+
+    page_size = page_size or state["page_size"]
+    max_bytes = max_bytes or state["max_bytes"]
+    try:
+        r = await get_db()
+        page, next_offset, total = await format_page(
+            r, state["graph"], state["res"], state["compact"], state["offset"], page_size, max_bytes
+        )
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
+    if state["graph"] == GRAPH_NAME:
+        label_cache.remember_nodes(page)
+    next_cursor = None
+    if next_offset is not None:
+        next_cursor = open_cursor(state["graph"], state["res"], next_offset, page_size, max_bytes, state["compact"])
+    return json.dumps({
+        "status": "success",
+        "graph": state["graph"],
+        "results": page,
+        "offset": state["offset"],
+        "total_rows": total,
+        "cursor": next_cursor
+    })
+
+
 @mcp.tool()
 async def create_session(session_id: str, name: str, topic: str, trigger: str, date: str, year: int) -> str:
     """Відкриває нову сесію в графі та налаштовує хронологічні вузли (Year, Day)."""
     try:
+        # fromisoformat з Python 3.11 приймає й YYYYMMDD, а day_id будується з YYYY-MM-DD
+        parsed_date = datetime.date.fromisoformat(date)
+        if parsed_date.isoformat() != date:
+            raise ValueError(f"Invalid date '{date}', expected YYYY-MM-DD")
         r = await get_db()
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
         
     queries = []
     # 1. Session
-    props = f"name: {e_str(name)}, topic: {e_str(topic)}, status: 'active', trigger: {e_str(trigger)}"
-    queries.append(f"MERGE (s:Session {{id: '{session_id}'}}) SET s += {{{props}}}")
+    props = prop_map({"name": name, "topic": topic, "status": "active", "trigger": trigger})
+    queries.append(render_query("session", {"id": session_id, "props": props}))
     
     # 2. Year & Day
-    month_num = date.split('-')[1]
+    month_num = parsed_date.month
     y_id = f"year_{year}"
     day_id = f"d_{date.replace('-','_')}"
-    queries.append(f"MERGE (y:Year {{value: {year}, id: '{y_id}', name: '{year}'}})")
-    queries.append(f"MERGE (d:Day {{date: '{date}', id: '{day_id}', name: '{date}'}})")
-    queries.append(f"MATCH (y:Year {{id: '{y_id}'}}), (d:Day {{id: '{day_id}'}}) MERGE (y)-[:MONTH {{number: {month_num}}}]->(d)")
+    queries.append(render_query("year", {"value": year, "id": y_id, "name": str(year)}))
+    queries.append(render_query("day", {"date": date, "id": day_id, "name": date}))
+    queries.append(render_query("month", {"year_id": y_id, "day_id": day_id, "number": month_num}))
     
     results = []
     for q in queries:
         try:
-            await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
+            await graph_query(r, q)
             results.append({"query": q, "status": "success"})
         except Exception as e:
             results.append({"query": q, "status": "error", "message": str(e)})
             
+    label_cache.put(session_id, "Session")
+    label_cache.put(y_id, "Year")
+    label_cache.put(day_id, "Day")
     return json.dumps({"status": "success", "results": results})
 
 
@@ -195,6 +981,10 @@ async def add_node(node_type: str, node_data: dict, day_id: str = None, time: st
     """
     Додає вузол в граф та зв'язує його з днем та іншими вузлами.
     relations is a list of dicts: [{"type": "PART_OF", "target_id": "session_01", "props": {}}]
+    Необов'язковий "target_label" у relation дозволяє шукати ціль по індексу.
+    Вузол, HAPPENED_AT і всі relations записуються одним атомарним запитом;
+    статус кожного relation повертається окремо: {"type", "target_id", "query", "status", "message"?},
+    де query — запит, яким записано зв'язок (null для relations, відхилених до відправки).
     """
     try:
         r = await get_db()
@@ -205,51 +995,121 @@ async def add_node(node_type: str, node_data: dict, day_id: str = None, time: st
     if not n_id:
         return json.dumps({"status": "error", "message": "Missing node id"})
         
-    queries = []
-    props = ", ".join([f"{k}: {e_str(v)}" for k, v in node_data.items() if k != 'id'])
-    queries.append(f"MERGE (n:{node_type} {{id: '{n_id}'}}) SET n += {{{props}}}")
-    
-    if day_id and time and node_type != 'Entity':
-        queries.append(f"MATCH (n {{id: '{n_id}'}}), (d:Day {{id: '{day_id}'}}) MERGE (n)-[:HAPPENED_AT {{time: '{time}'}}]->(d)")
-        
+    n_id = str(n_id)
+    try:
+        cypher_ident(node_type)
+    except ValueError as e:
+        return json.dumps({"status": "error", "message": str(e)})
+    await ensure_id_index(r, node_type)
+
+    link_day = bool(day_id and time and node_type != 'Entity')
+    params = {"id": n_id, "props": prop_map(node_data, skip=('id',))}
+    if link_day:
+        params.update({"day_id": day_id, "time": time})
+
+    # relations групуються за (тип, мітка цілі): тип зв'язку не можна передати параметром
+    rel_results = []
+    groups = {}
     for rel in relations:
         r_type = rel.get('type')
         target_id = rel.get('target_id')
         r_props = rel.get('props')
-        if not r_type or not target_id: continue
-        
-        if r_props and isinstance(r_props, dict):
-            ps = ", ".join([f"{k}: {e_str(v)}" for k, v in r_props.items()])
-            queries.append(f"MATCH (s {{id: '{n_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[r:{r_type}]->(t) SET r += {{{ps}}}")
-        else:
-            queries.append(f"MATCH (s {{id: '{n_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[:{r_type}]->(t)")
-            
-    results = []
-    for q in queries:
+        entry = {"type": r_type, "target_id": target_id, "query": None}
+        rel_results.append(entry)
+        if not r_type or not target_id:
+            entry.update({"status": "error", "message": "Missing type or target_id"})
+            continue
+        target_id = entry["target_id"] = str(target_id)
+        explicit_label = rel.get('target_label') or None
+        target_label = explicit_label or label_cache.get(target_id)
         try:
-            await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
-            results.append({"query": q, "status": "success"})
+            cypher_ident(r_type)
+            if target_label:
+                cypher_ident(target_label)
+        except ValueError as e:
+            entry.update({"status": "error", "message": str(e)})
+            continue
+        entry["from_cache"] = target_label is not None and explicit_label is None
+        groups.setdefault((r_type, target_label), []).append({
+            "idx": len(rel_results) - 1,
+            "target_id": target_id,
+            "props": prop_map(r_props) if isinstance(r_props, dict) else {}
+        })
+
+    q = render_add_node(node_type, params, groups, link_day, merge_node=True)
+    for rows in groups.values():
+        for row in rows:
+            rel_results[row["idx"]]["query"] = q
+    try:
+        res = await graph_query(r, q, compact=True)
+    except Exception as e:
+        for entry in rel_results:
+            entry.setdefault("status", "error")
+            entry.setdefault("message", "Not written: node statement failed")
+            entry.pop("from_cache", None)
+        return json.dumps({"status": "success", "results": [
+            {"query": q, "status": "error", "message": str(e)}
+        ] + rel_results})
+    label_cache.put(n_id, node_type)
+
+    node_result = {"query": q, "status": "success"}
+    day_linked, linked = unpack_add_node_result(res, link_day)
+    if link_day:
+        node_result["day_linked"] = day_linked
+
+    # Цілі з застарілою кешованою міткою повторюємо окремим запитом без мітки
+    stale = {}
+    for (r_type, target_label), rows in groups.items():
+        for row in rows:
+            if row["idx"] not in linked and rel_results[row["idx"]]["from_cache"]:
+                label_cache.discard(row["target_id"])
+                stale.setdefault((r_type, None), []).append(row)
+    if stale:
+        label_cache.stale += 1
+        retry_q = render_add_node(node_type, {"id": n_id}, stale, False, merge_node=False)
+        for rows in stale.values():
+            for row in rows:
+                rel_results[row["idx"]]["query"] = retry_q
+        try:
+            _, retry_linked = unpack_add_node_result(await graph_query(r, retry_q, compact=True), False)
+            linked.update(retry_linked)
         except Exception as e:
-            results.append({"query": q, "status": "error", "message": str(e)})
+            logger.error(f"add_node relation retry failed: {e}")
+
+    for idx, entry in enumerate(rel_results):
+        if entry.pop("from_cache", None) is None:
+            continue
+        if idx in linked:
+            entry["status"] = "success"
+            label_cache.put(entry["target_id"], linked[idx])
+        else:
+            entry.update({"status": "error", "message": "Target node not found"})
             
-    return json.dumps({"status": "success", "results": results})
+    return json.dumps({"status": "success", "results": [node_result] + rel_results})
 
 
 @mcp.tool()
-async def link_nodes(source_id: str, target_id: str, rel_type: str, props: dict = None) -> str:
-    """Створює зв'язок між двома вузлами (наприклад NEXT)."""
+async def link_nodes(source_id: str, target_id: str, rel_type: str, props: dict = None,
+                     source_label: str = None, target_label: str = None) -> str:
+    """
+    Створює зв'язок між двома вузлами (наприклад NEXT).
+    source_label/target_label (необов'язково) дозволяють шукати вузли по індексу на id.
+    """
     try:
         r = await get_db()
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
     
-    if props:
-        ps = ", ".join([f"{k}: {e_str(v)}" for k, v in props.items()])
-        q = f"MATCH (s {{id: '{source_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[r:{rel_type}]->(t) SET r += {{{ps}}}"
-    else:
-        q = f"MATCH (s {{id: '{source_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[:{rel_type}]->(t)"
     try:
-        await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
+        q, res = await run_resolved(r, "link", {
+            "source_id": source_id,
+            "target_id": target_id,
+            "props": prop_map(props) if props else {}
+        }, rel_type=rel_type, source_id=source_id, target_id=target_id,
+            source_label=source_label, target_label=target_label)
+        for row in decode_falkor(res[1])[:1] if has_rows(res) else []:
+            label_cache.put(source_id, row[0])
+            label_cache.put(target_id, row[1])
         return json.dumps({"status": "success", "query": q})
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
@@ -263,88 +1123,174 @@ async def update_last_event(session_id: str, event_id: str) -> str:
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
     
-    queries = [
-        f"MATCH (s:Session {{id: '{session_id}'}})-[rel:LAST_EVENT]->() DELETE rel",
-        f"MATCH (s:Session {{id: '{session_id}'}}), (last {{id: '{event_id}'}}) MERGE (s)-[:LAST_EVENT]->(last)"
-    ]
     results = []
-    for q in queries:
-        try:
-            await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
-            results.append({"query": q, "status": "success"})
-        except Exception as e:
-            results.append({"query": q, "status": "error", "message": str(e)})
+    q = render_query("clear_last_event", {"session_id": session_id})
+    try:
+        await graph_query(r, q)
+        results.append({"query": q, "status": "success"})
+    except Exception as e:
+        results.append({"query": q, "status": "error", "message": str(e)})
+    set_params = {"session_id": session_id, "event_id": event_id}
+    set_q = render_query("set_last_event", set_params)
+    try:
+        set_q, res = await run_resolved(r, "set_last_event", set_params, target_id=event_id)
+        for row in decode_falkor(res[1])[:1] if has_rows(res) else []:
+            label_cache.put(event_id, row[0])
+        results.append({"query": set_q, "status": "success"})
+    except Exception as e:
+        results.append({"query": set_q, "status": "error", "message": str(e)})
     return json.dumps({"status": "success", "results": results})
 
 
 @mcp.tool()
-async def batch_add_nodes(node_type: str, nodes: list, day_id: str = None, time: str = None) -> str:
+async def batch_add_nodes(node_type: str, nodes: list, day_id: str = None, time: str = None, chunk_size: int = None) -> str:
     """
     Додає декілька вузлів одного типу (наприклад, Entity) в граф за один раз.
+    Вузли відправляються пачками по chunk_size (за замовчуванням BATCH_CHUNK_SIZE)
+    одним UNWIND-запитом на пачку. Статус повертається для кожного вузла окремо:
+    {"id", "query", "status", "message"?, "day_linked"?}, де query — UNWIND-запит пачки
+    (null для вузлів, відхилених до відправки).
     """
     try:
         r = await get_db()
+        cypher_ident(node_type)
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
+    await ensure_id_index(r, node_type)
 
-    queries = []
-    for node_data in nodes:
-        n_id = node_data.get('id')
+    results = [None] * len(nodes)
+    rows = []
+    for idx, node_data in enumerate(nodes):
+        n_id = node_data.get('id') if isinstance(node_data, dict) else None
         if not n_id:
+            results[idx] = {"id": None, "query": None, "status": "error", "message": "Missing node id"}
             continue
-        
-        props = ", ".join([f"{k}: {e_str(v)}" for k, v in node_data.items() if k != 'id'])
-        queries.append(f"MERGE (n:{node_type} {{id: '{n_id}'}}) SET n += {{{props}}}")
-        
-        if day_id and time and node_type != 'Entity':
-            queries.append(f"MATCH (n {{id: '{n_id}'}}), (d:Day {{id: '{day_id}'}}) MERGE (n)-[:HAPPENED_AT {{time: '{time}'}}]->(d)")
+        rows.append({"idx": idx, "id": str(n_id), "props": prop_map(node_data, skip=('id',))})
 
-    results = []
-    for q in queries:
-        try:
-            await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
-            results.append({"query": q, "status": "success"})
-        except Exception as e:
-            results.append({"query": q, "status": "error", "message": str(e)})
+    link_day = bool(day_id and time and node_type != 'Entity')
+    if link_day:
+        query = query_template("batch_nodes_day", label=node_type)
+        params = {"day_id": day_id, "time": time}
+    else:
+        query = query_template("batch_nodes", label=node_type)
+        params = {}
 
-    return json.dumps({"status": "success", "results": results})
+    returned, failed, chunks = await run_unwind_batches(r, query, rows, chunk_size, params)
+    for row in rows:
+        idx = row["idx"]
+        if idx in failed:
+            results[idx] = {"id": row["id"], "query": query, "status": "error", "message": failed[idx]}
+        elif idx in returned:
+            results[idx] = {"id": row["id"], "query": query, "status": "success"}
+            label_cache.put(row["id"], node_type)
+            if link_day:
+                results[idx]["day_linked"] = returned[idx][0] == 'true'
+        else:
+            results[idx] = {"id": row["id"], "query": query, "status": "error", "message": "Node was not written"}
+
+    return json.dumps({"status": "success", "queries_sent": chunks, "results": results})
 
 
 @mcp.tool()
-async def batch_link_nodes(links: list) -> str:
+async def batch_link_nodes(links: list, chunk_size: int = None) -> str:
     """
     Створює декілька зв'язків між вузлами за один раз.
+    Зв'язки групуються за типом (і мітками) та відправляються пачками по chunk_size
+    (за замовчуванням BATCH_CHUNK_SIZE) одним UNWIND-запитом на пачку.
+    Кожен link може мати необов'язкові "source_label"/"target_label" для пошуку по індексу.
+    Результат для кожного зв'язку: {"source_id", "target_id", "type", "query", "status", "message"?},
+    де query — UNWIND-запит пачки (null для зв'язків, відхилених до відправки).
     """
     try:
         r = await get_db()
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
 
-    queries = []
-    for link in links:
+    results = [None] * len(links)
+    pending = []
+    for idx, link in enumerate(links):
+        link = link if isinstance(link, dict) else {}
         source_id = link.get('source_id')
         target_id = link.get('target_id')
         rel_type = link.get('type')
         props = link.get('props')
-        
+        source_label = link.get('source_label') or None
+        target_label = link.get('target_label') or None
+
         if not source_id or not target_id or not rel_type:
+            results[idx] = {"source_id": source_id, "target_id": target_id, "type": rel_type, "query": None,
+                            "status": "error", "message": "Missing source_id, target_id or type"}
             continue
-            
-        if props:
-            ps = ", ".join([f"{k}: {e_str(v)}" for k, v in props.items()])
-            queries.append(f"MATCH (s {{id: '{source_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[r:{rel_type}]->(t) SET r += {{{ps}}}")
-        else:
-            queries.append(f"MATCH (s {{id: '{source_id}'}}), (t {{id: '{target_id}'}}) MERGE (s)-[:{rel_type}]->(t)")
-
-    results = []
-    for q in queries:
         try:
-            await r.execute_command("GRAPH.QUERY", GRAPH_NAME, q)
-            results.append({"query": q, "status": "success"})
-        except Exception as e:
-            results.append({"query": q, "status": "error", "message": str(e)})
+            query_template("batch_links", rel_type=rel_type, source_label=source_label, target_label=target_label)
+        except ValueError as e:
+            results[idx] = {"source_id": source_id, "target_id": target_id, "type": rel_type, "query": None,
+                            "status": "error", "message": str(e)}
+            continue
 
-    return json.dumps({"status": "success", "results": results})
+        pending.append((rel_type, source_label, target_label, {
+            "idx": idx,
+            "source_id": str(source_id),
+            "target_id": str(target_id),
+            "props": prop_map(props) if isinstance(props, dict) else {}
+        }))
+
+    async def send(items, use_cache):
+        # Відсутні мітки беремо з label_cache; групуємо за (тип, мітка джерела, мітка цілі)
+        groups = {}
+        from_cache = set()
+        for rel_type, source_label, target_label, row in items:
+            sl, tl = source_label, target_label
+            if use_cache:
+                sl = sl or label_cache.get(row["source_id"])
+                tl = tl or label_cache.get(row["target_id"])
+                if (sl, tl) != (source_label, target_label):
+                    from_cache.add(row["idx"])
+            groups.setdefault((rel_type, sl, tl), []).append(row)
+        returned, failed, sent = {}, {}, 0
+        for (rel_type, sl, tl), rows in groups.items():
+            query = query_template("batch_links", rel_type=rel_type, source_label=sl, target_label=tl)
+            for row in rows:
+                queries[row["idx"]] = query
+            group_returned, group_failed, group_sent = await run_unwind_batches(r, query, rows, chunk_size)
+            returned.update(group_returned)
+            failed.update(group_failed)
+            sent += group_sent
+        return returned, failed, sent, from_cache
+
+    queries = {}
+    returned, failed, chunks, from_cache = await send(pending, use_cache=True)
+
+    # Зв'язки з кешованими мітками, які нічого не знайшли, повторюємо без них
+    stale = [item for item in pending
+             if item[3]["idx"] in from_cache and item[3]["idx"] not in returned and item[3]["idx"] not in failed]
+    if stale:
+        label_cache.stale += 1
+        for _, source_label, target_label, row in stale:
+            if not source_label:
+                label_cache.discard(row["source_id"])
+            if not target_label:
+                label_cache.discard(row["target_id"])
+        retry_returned, retry_failed, retry_sent, _ = await send(stale, use_cache=False)
+        returned.update(retry_returned)
+        failed.update(retry_failed)
+        chunks += retry_sent
+
+    for rel_type, _, _, row in pending:
+        idx = row["idx"]
+        entry = {"source_id": row["source_id"], "target_id": row["target_id"], "type": rel_type,
+                 "query": queries.get(idx)}
+        if idx in failed:
+            entry.update({"status": "error", "message": failed[idx]})
+        elif idx in returned:
+            entry["status"] = "success"
+            label_cache.put(row["source_id"], returned[idx][0])
+            label_cache.put(row["target_id"], returned[idx][1])
+        else:
+            entry.update({"status": "error", "message": "Source or target node not found"})
+        results[idx] = entry
+
+    return json.dumps({"status": "success", "queries_sent": chunks, "results": results})
 
 
 @mcp.tool()
@@ -352,25 +1298,47 @@ async def delete_node(node_id: str) -> str:
     """Видаляє вузол з графа (включаючи всі його зв'язки)."""
     try:
         r = await get_db()
-        query = f"MATCH (n {{id: '{node_id}'}}) DETACH DELETE n"
-        await r.execute_command("GRAPH.QUERY", GRAPH_NAME, query)
+        query, _ = await run_resolved(r, "delete_node", {"id": node_id}, source_id=node_id,
+                                      matched=lambda res: query_stat(res, "Nodes deleted") > 0)
+        label_cache.discard(node_id)
         return json.dumps({"status": "success", "query": query})
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
 
 
 @mcp.tool()
-async def delete_link(source_id: str, target_id: str, rel_type: str) -> str:
-    """Видаляє конкретний зв'язок між вузлами."""
+async def delete_link(source_id: str, target_id: str, rel_type: str,
+                      source_label: str = None, target_label: str = None) -> str:
+    """Видаляє конкретний зв'язок між вузлами (мітки необов'язкові, для пошуку по індексу)."""
     try:
         r = await get_db()
-        query = f"MATCH (s {{id: '{source_id}'}})-[r:{rel_type}]->(t {{id: '{target_id}'}}) DELETE r"
-        await r.execute_command("GRAPH.QUERY", GRAPH_NAME, query)
+        query, _ = await run_resolved(r, "delete_link", {"source_id": source_id, "target_id": target_id},
+                                      rel_type=rel_type, source_id=source_id, target_id=target_id,
+                                      source_label=source_label, target_label=target_label,
+                                      matched=lambda res: query_stat(res, "Relationships deleted") > 0)
         return json.dumps({"status": "success", "query": query})
     except Exception as e:
         return json.dumps({"status": "error", "message": str(e)})
 
 
+@mcp.tool()
+async def ensure_indexes(labels: list = None) -> str:
+    """
+    Перевіряє та створює range-індекси на id для міток поточного графа.
+    labels: мітки для перевірки (за замовчуванням — DEFAULT_INDEXED_LABELS та всі мітки, які вже писав сервер).
+    Повертає, які індекси вже існували, які створено, та помилки.
+    """
+    try:
+        r = await get_db()
+        targets = labels if labels else DEFAULT_INDEXED_LABELS + sorted(indexed_labels)
+        for label in targets:
+            cypher_ident(label)
+        report = await provision_id_indexes(r, targets)
+        return json.dumps({"status": "success", "graph": GRAPH_NAME, **report})
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
+
+
 @mcp.tool()
 async def list_graphs() -> str:
     """
@@ -386,6 +1354,28 @@ async def list_graphs() -> str:
         return json.dumps({"status": "error", "message": str(e)})
 
 
+@mcp.tool()
+async def graph_versions(graphs: list = None) -> str:
+    """
+    Лічильники змін графів: кожен запис через інструменти сервісу (add_node, link_nodes,
+    batch_*, delete_*, query_graph із записом, copy_graph) збільшує лічильник графа.
+    Незмінний лічильник означає, що граф не змінювався, — на цьому будуються кеші клієнтів.
+    graphs: назви графів (за замовчуванням — поточний граф GRAPH_NAME).
+    default_graph у відповіді — граф, у який пишуть add_node/link_nodes без явного графа.
+    """
+    target_graphs = graphs if graphs else [GRAPH_NAME]
+    try:
+        r = await get_db()
+        values = await r.mget([GRAPH_VERSION_KEY + g for g in target_graphs])
+        return json.dumps({
+            "status": "success",
+            "versions": {g: int(v) if v is not None else 0 for g, v in zip(target_graphs, values)},
+            "default_graph": GRAPH_NAME
+        })
+    except Exception as e:
+        return json.dumps({"status": "error", "message": str(e)})
+
+
 @mcp.tool()
 async def copy_graph(source_graph: str, destination_graph: str) -> str:
     """
@@ -395,6 +1385,9 @@ async def copy_graph(source_graph: str, destination_graph: str) -> str:
     try:
         r = await get_db()
         await r.execute_command("GRAPH.COPY", source_graph, destination_graph)
+        await r.incr(GRAPH_VERSION_KEY + destination_graph)
+        invalidate_graph(destination_graph)
+        graph_schemas.pop(destination_graph, None)
         return json.dumps({
             "status": "success",
             "message": f"Graph '{source_graph}' copied to '{destination_graph}'",
@@ -4,6 +4,13 @@ import asyncio
 import json
 import threading
 import logging
+import time
+import heapq
+import random
+import hashlib
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from itertools import islice
 from contextvars import ContextVar
 from dataclasses import dataclass, field
 from io import StringIO
@@ -27,25 +34,231 @@ load_dotenv()
 
 current_task_id = ContextVar("current_task_id", default=None)
 
+TASK_LOG_CAPACITY = int(os.environ.get("TASK_LOG_CAPACITY", "2000"))
+
 @dataclass
 class TaskState:
     id: str
-    status: str  # "running", "completed", "failed", "cancelled"
-    logs_buffer: list = field(default_factory=list)
+    status: str  # "queued", "running", "completed", "failed", "cancelled"
+    # Кільцевий буфер останніх TASK_LOG_CAPACITY рядків; log_seq — номер наступного рядка
+    logs_buffer: deque = field(default_factory=lambda: deque(maxlen=TASK_LOG_CAPACITY))
+    log_seq: int = 0
+    log_bytes: int = 0
     result: str = None
     error: str = None
     task_obj: asyncio.Task = None
+    partial_chunks: list = field(default_factory=list)
+    partial_len: int = 0
+    finished_at: float = None
+    # Замінюється новим Event при кожній зміні (лог, фрагмент відповіді, завершення) — для wait_task
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    loop: asyncio.AbstractEventLoop = None
+
+    def __post_init__(self):
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+
+    def signal(self):
+        """Будить усіх, хто чекає на state.changed; безпечно викликати з інших потоків."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self.signal)
+            return
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def finish(self, status: str, result: str = None, error: str = None):
+        """Фіксує кінцевий стан; з цього моменту задача підлягає TTL/LRU витісненню."""
+        self.result = result
+        self.error = error
+        self.status = status
+        self.finished_at = time.time()
+        self.task_obj = None
+        self.signal()
+
+    def approx_bytes(self) -> int:
+        return self.log_bytes + len(self.result or "") + len(self.error or "") + self.partial_len
+
+    def append_log(self, line: str):
+        with log_lock:
+            if len(self.logs_buffer) == self.logs_buffer.maxlen:
+                self.log_bytes -= len(self.logs_buffer[0])
+            self.logs_buffer.append(line)
+            self.log_bytes += len(line)
+            self.log_seq += 1
+        self.signal()
+
+    def logs_since(self, seq: int) -> tuple[list, int, int]:
+        """
+        (рядки з номером >= seq, наступний seq, кількість рядків, що вже витіснені з буфера).
+        Вартість пропорційна кількості нових рядків, а не всій історії.
+        """
+        with log_lock:
+            first = self.log_seq - len(self.logs_buffer)
+            start = max(seq, first)
+            lines = list(islice(reversed(self.logs_buffer), max(self.log_seq - start, 0)))
+            return lines[::-1], self.log_seq, max(first - seq, 0)
+
+    def to_dict(self) -> dict:
+        text, _ = self.partial_since(0)
+        with log_lock:
+            logs = list(self.logs_buffer)
+        return {
+            "id": self.id, "status": self.status, "logs": logs, "log_seq": self.log_seq,
+            "result": self.result, "error": self.error, "partial": text, "finished_at": self.finished_at
+        }
 
-TaskManager: dict[str, TaskState] = {}
+    @classmethod
+    def from_dict(cls, data: dict) -> "TaskState":
+        partial = data.get("partial") or ""
+        logs = deque(data.get("logs", []), maxlen=TASK_LOG_CAPACITY)
+        return cls(
+            id=data["id"], status=data["status"], logs_buffer=logs,
+            log_seq=data.get("log_seq", len(logs)), log_bytes=sum(len(line) for line in logs),
+            result=data.get("result"), error=data.get("error"),
+            partial_chunks=[partial] if partial else [], partial_len=len(partial),
+            finished_at=data.get("finished_at")
+        )
+
+    def append_partial(self, text: str):
+        """Дописує фрагмент потокової відповіді моделі (див. LLM_STREAMING)."""
+        with log_lock:
+            self.partial_chunks.append(text)
+            self.partial_len += len(text)
+        self.signal()
+
+    def partial_since(self, offset: int) -> tuple[str, int]:
+        """(текст після offset, поточна довжина) — атомарно відносно append_partial."""
+        with log_lock:
+            if len(self.partial_chunks) > 1:
+                self.partial_chunks = ["".join(self.partial_chunks)]
+            text = self.partial_chunks[0] if self.partial_chunks else ""
+        return text[max(offset, 0):], len(text)
+
+TASK_MAX_TASKS = int(os.environ.get("TASK_MAX_TASKS", "200"))
+TASK_TTL = float(os.environ.get("TASK_TTL", "3600"))
+TASK_SPILL_DIR = os.environ.get("TASK_SPILL_DIR", "")
+TASK_SPILL_TTL = float(os.environ.get("TASK_SPILL_TTL", str(7 * 24 * 3600)))
+
+class TaskRegistry:
+    """
+    Реєстр задач з обмеженням розміру: завершені задачі витісняються після TASK_TTL
+    або за LRU, коли задач більше TASK_MAX_TASKS. Задачі, що виконуються, не витісняються.
+    Якщо задано spill_dir, витіснена задача зберігається на диск і лишається доступною через get().
+    """
+    def __init__(self, max_tasks: int, ttl: float, spill_dir: str = "", spill_ttl: float = 0):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self._tasks: OrderedDict[str, TaskState] = OrderedDict()
+        self._spill_pruned_at = 0.0
+        self.expired = 0
+        self.evicted = 0
+        self.spilled = 0
+        self.restored = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def add(self, state: TaskState):
+        self._tasks[state.id] = state
+        self.prune()
+
+    def live(self, task_id: str):
+        """Задача в пам'яті без торкання LRU та диска — для лог-хендлера."""
+        return self._tasks.get(task_id)
+
+    def get(self, task_id: str):
+        # Без нових add() прострочені задачі інакше лишались би в пам'яті
+        self.prune()
+        state = self._tasks.get(task_id)
+        if state is not None:
+            self._tasks.move_to_end(task_id)
+            return state
+        return self._restore(task_id)
+
+    def prune(self):
+        now = time.time()
+        for task_id, state in list(self._tasks.items()):
+            if state.finished_at is not None and now - state.finished_at > self.ttl:
+                self._drop(task_id)
+                self.expired += 1
+        if len(self._tasks) > self.max_tasks:
+            for task_id, state in list(self._tasks.items()):
+                if len(self._tasks) <= self.max_tasks:
+                    break
+                if state.finished_at is not None:
+                    self._drop(task_id)
+                    self.evicted += 1
+        if self.spill_dir and now - self._spill_pruned_at > 60:
+            self._spill_pruned_at = now
+            self._prune_spill(now)
+
+    def _drop(self, task_id: str):
+        state = self._tasks.pop(task_id)
+        if self.spill_dir:
+            try:
+                path = self._spill_path(task_id)
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(state.to_dict(), f)
+                os.replace(path + ".tmp", path)
+                self.spilled += 1
+            except OSError as e:
+                logger.error(f"[task_registry] Failed to spill task {task_id}: {e}")
+
+    def _spill_path(self, task_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{os.path.basename(task_id)}.json")
+
+    def _restore(self, task_id: str):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self._spill_path(task_id), "r", encoding="utf-8") as f:
+                state = TaskState.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        self.restored += 1
+        return state
+
+    def _prune_spill(self, now: float):
+        try:
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                if now - os.path.getmtime(path) > self.spill_ttl:
+                    os.remove(path)
+        except OSError as e:
+            logger.error(f"[task_registry] Failed to prune spill dir: {e}")
+
+    def stats(self) -> dict:
+        self.prune()
+        running = sum(1 for s in self._tasks.values() if s.finished_at is None)
+        return {
+            "tasks": len(self._tasks),
+            "running": running,
+            "finished": len(self._tasks) - running,
+            "max_tasks": self.max_tasks,
+            "ttl": self.ttl,
+            "approx_bytes": sum(s.approx_bytes() for s in self._tasks.values()),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "spilled": self.spilled,
+            "restored": self.restored,
+            "spill_dir": self.spill_dir or None
+        }
+
+TaskManager = TaskRegistry(TASK_MAX_TASKS, TASK_TTL, TASK_SPILL_DIR, TASK_SPILL_TTL)
 log_lock = threading.Lock()
 
 class AsyncIOSafeLogHandler(logging.Handler):
     def emit(self, record):
         task_id = current_task_id.get()
-        if task_id and task_id in TaskManager:
-            msg = self.format(record)
-            with log_lock:
-                TaskManager[task_id].logs_buffer.append(msg + "\n")
+        state = TaskManager.live(task_id) if task_id else None
+        if state is not None:
+            state.append_log(self.format(record) + "\n")
 
 # Add the task-aware handler to our logger
 task_handler = AsyncIOSafeLogHandler()
@@ -59,41 +272,697 @@ def safe_print(*args, **kwargs):
 # Monkeypatch print for this module
 print = safe_print
 
-from fastmcp import FastMCP
+# --- Task Scheduler ---
+
+SCHED_DEFAULT_LIMIT = int(os.environ.get("SCHED_DEFAULT_LIMIT", "4"))
+# Ліміти через кому: "gemini=4,openai=2,gemini-2.5-pro=1" — точна назва моделі має пріоритет над провайдером
+SCHED_LIMITS = os.environ.get("SCHED_LIMITS", "")
+
+def model_provider(model: str) -> str:
+    model_lower = model.lower()
+    if "gemini" in model_lower:
+        return "gemini"
+    if "gpt" in model_lower or "o1" in model_lower or "o3" in model_lower:
+        return "openai"
+    return "other"
+
+class TaskScheduler:
+    """
+    Обмежує кількість одночасних фонових задач на модель/провайдера.
+    Надлишкові задачі чекають у черзі з пріоритетами (більший priority — раніше,
+    однаковий — FIFO) зі статусом "queued"; їх можна скасувати до старту.
+    """
+    def __init__(self, default_limit: int, limits: dict):
+        self.default_limit = default_limit
+        self.limits = limits
+        self._running: dict[str, int] = {}
+        self._queues: dict[str, list] = {}
+        self._seq = 0
+        self.started = 0
+        self.cancelled_queued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @staticmethod
+    def parse_limits(spec: str) -> dict:
+        limits = {}
+        for item in spec.split(","):
+            if "=" in item:
+                key, value = item.split("=", 1)
+                limits[key.strip()] = int(value)
+        return limits
+
+    def key_for(self, model: str) -> str:
+        if model in self.limits:
+            return model
+        return model_provider(model)
+
+    def submit(self, state: TaskState, model: str, priority: int, factory):
+        """factory() повертає корутину задачі; вона стартує одразу або після звільнення слота."""
+        key = self.key_for(model)
+        if self._running.get(key, 0) < self.limits.get(key, self.default_limit):
+            self._start(key, state, factory, time.time())
+            return
+        self._seq += 1
+        state.status = "queued"
+        heapq.heappush(self._queues.setdefault(key, []), (-priority, self._seq, time.time(), state, factory))
+
+    def cancel_queued(self, state: TaskState) -> bool:
+        for key, queue in self._queues.items():
+            for i, entry in enumerate(queue):
+                if entry[3] is state:
+                    queue.pop(i)
+                    heapq.heapify(queue)
+                    self.cancelled_queued += 1
+                    state.finish("cancelled", error="Cancelled by user before start")
+                    return True
+        return False
+
+    def queue_position(self, state: TaskState):
+        for queue in self._queues.values():
+            ordered = sorted(queue)
+            for i, entry in enumerate(ordered):
+                if entry[3] is state:
+                    return i + 1
+        return None
+
+    def _start(self, key: str, state: TaskState, factory, queued_at: float):
+        waited = time.time() - queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.started += 1
+        self._running[key] = self._running.get(key, 0) + 1
+        state.status = "running"
+        state.signal()
+        state.task_obj = asyncio.create_task(factory())
+        state.task_obj.add_done_callback(lambda _: self._release(key))
+
+    def _release(self, key: str):
+        self._running[key] -= 1
+        queue = self._queues.get(key)
+        if queue:
+            _, _, queued_at, state, factory = heapq.heappop(queue)
+            self._start(key, state, factory, queued_at)
+
+    def stats(self) -> dict:
+        keys = set(self._running) | set(self._queues) | set(self.limits)
+        return {
+            "default_limit": self.default_limit,
+            "per_key": {
+                key: {
+                    "limit": self.limits.get(key, self.default_limit),
+                    "running": self._running.get(key, 0),
+                    "queued": len(self._queues.get(key, []))
+                }
+                for key in sorted(keys)
+            },
+            "queue_depth": sum(len(q) for q in self._queues.values()),
+            "started": self.started,
+            "cancelled_queued": self.cancelled_queued,
+            "avg_wait_seconds": round(self.wait_total / self.started, 3) if self.started else 0.0,
+            "max_wait_seconds": round(self.wait_max, 3)
+        }
+
+scheduler = TaskScheduler(SCHED_DEFAULT_LIMIT, TaskScheduler.parse_limits(SCHED_LIMITS))
+
+# --- Grynya MCP Session Pool ---
+
+GRYNYA_MCP_URL = os.environ.get("GRYNYA_MCP_URL", "http://grynya-mcp-server:8000/sse")
+GRYNYA_POOL_SIZE = int(os.environ.get("GRYNYA_POOL_SIZE", "4"))
+GRYNYA_CONNECT_TIMEOUT = float(os.environ.get("GRYNYA_CONNECT_TIMEOUT", "15"))
+GRYNYA_CALL_TIMEOUT = float(os.environ.get("GRYNYA_CALL_TIMEOUT", "120"))
+GRYNYA_TOOLS_TTL = float(os.environ.get("GRYNYA_TOOLS_TTL", "300"))
+
+class GrynyaConnection:
+    """
+    Одна ініціалізована ClientSession до grynya-mcp-server.
+    sse_client тримається окремою фоновою задачею: anyio вимагає виходити
+    з контекстів у тій самій задачі, в якій у них увійшли.
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.session = None
+        self.error = None
+        self._read_stream = None
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._task = None
+
+    @property
+    def alive(self) -> bool:
+        # sse_reader закриває свій кінець потоку, щойно SSE-з'єднання обірвалось
+        # (наприклад, сервер перезапустили) — така сесія вже не доставить відповідь
+        return (
+            self.session is not None and self._task is not None and not self._task.done()
+            and self._read_stream.statistics().open_send_streams > 0
+        )
+
+    async def open(self):
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._ready.wait(), GRYNYA_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise ConnectionError(f"Timed out connecting to {self.url}")
+        if self.session is None:
+            raise ConnectionError(f"Failed to connect to {self.url}: {self.error}")
+
+    async def _run(self):
+        import datetime
+        from mcp.client.sse import sse_client
+        from mcp.client.session import ClientSession
+
+        # Логи з'єднання не повинні потрапляти в буфер задачі, яка його відкрила
+        current_task_id.set(None)
+        try:
+            async with sse_client(self.url, headers={"Host": "localhost"}) as streams:
+                self._read_stream = streams[0]
+                read_timeout = datetime.timedelta(seconds=GRYNYA_CALL_TIMEOUT)
+                async with ClientSession(streams[0], streams[1], read_timeout_seconds=read_timeout) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._closing.wait()
+        except Exception as e:
+            self.error = e
+            logger.warning(f"[grynya_pool] Connection to {self.url} closed: {e}")
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def close(self):
+        self._closing.set()
+        if self._task is None or self._task.done():
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), 5)
+        except Exception:
+            self._task.cancel()
+
+def request_not_sent(e: Exception) -> bool:
+    """Помилки, після яких запит гарантовано не дійшов до grynya-mcp-server."""
+    import anyio
+    import httpx
+    return isinstance(e, (ConnectionError, anyio.ClosedResourceError, anyio.BrokenResourceError, httpx.ConnectError))
+
+class GrynyaPool:
+    """
+    Пул ініціалізованих MCP-сесій до grynya-mcp-server.
+    Кількість одночасно зайнятих сесій обмежена size; сесія, на якій виклик впав,
+    закривається, а наступний acquire відкриває нову. Список інструментів кешується на tools_ttl.
+    """
+    def __init__(self, url: str, size: int, tools_ttl: float):
+        self.url = url
+        self.size = size
+        self.tools_ttl = tools_ttl
+        self._slots = asyncio.Semaphore(size)
+        self._idle: list[GrynyaConnection] = []
+        self._tools = None
+        self._tools_at = 0.0
+        self.opened = 0
+        self.reused = 0
+        self.dropped = 0
+
+    @asynccontextmanager
+    async def session(self):
+        async with self._slots:
+            conn = None
+            while self._idle:
+                candidate = self._idle.pop()
+                if candidate.alive:
+                    conn = candidate
+                    self.reused += 1
+                    break
+                self.dropped += 1
+                await candidate.close()
+            if conn is None:
+                conn = GrynyaConnection(self.url)
+                await conn.open()
+                self.opened += 1
+            try:
+                yield conn.session
+            except BaseException:
+                # Стан сесії після збою або скасування невідомий — не повертаємо її в пул
+                self.dropped += 1
+                await conn.close()
+                raise
+            if conn.alive:
+                self._idle.append(conn)
+
+    async def call_tool(self, name: str, arguments: dict = None):
+        """
+        call_tool з одним повтором на новій сесії, якщо запит не вдалося відправити
+        (з'єднання не відкрилось або вже закрите). Таймаут чи обрив після відправки
+        не повторюються: сервер міг уже виконати запис (add_node, link_nodes, batch_*).
+        """
+        try:
+            async with self.session() as session:
+                return await session.call_tool(name, arguments=arguments)
+        except Exception as e:
+            if not request_not_sent(e):
+                raise
+            logger.warning(f"[grynya_pool] {name} was not sent ({e!r}), reconnecting...")
+        async with self.session() as session:
+            return await session.call_tool(name, arguments=arguments)
+
+    async def list_tools(self) -> list:
+        now = time.monotonic()
+        if self._tools is None or now - self._tools_at > self.tools_ttl:
+            async with self.session() as session:
+                self._tools = (await session.list_tools()).tools
+            self._tools_at = time.monotonic()
+        return self._tools
+
+    async def warm_up(self):
+        """Відкриває одну сесію заздалегідь, щоб перша задача не чекала handshake."""
+        try:
+            async with self.session():
+                pass
+        except Exception as e:
+            logger.warning(f"[grynya_pool] Warm-up failed: {e}")
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "opened": self.opened,
+            "reused": self.reused,
+            "dropped": self.dropped,
+            "tools_cached": self._tools is not None
+        }
+
+grynya_pool = GrynyaPool(GRYNYA_MCP_URL, GRYNYA_POOL_SIZE, GRYNYA_TOOLS_TTL)
+
+# --- Graph Backends ---
+
+GRAPH_BACKEND = os.environ.get("GRAPH_BACKEND", "mcp")
+# Каталог з main.py falkordb-service; у docker-compose змонтований у /grynya-service
+GRYNYA_SERVICE_PATH = os.environ.get(
+    "GRYNYA_SERVICE_PATH",
+    os.path.join(os.path.dirname(__file__), "..", "..", "falkordb-service", "mcp")
+)
+
+class McpGraphBackend:
+    """Інструменти grynya-mcp-server через пул MCP-сесій (SSE)."""
+    name = "mcp"
+
+    def __init__(self, pool: GrynyaPool):
+        self.pool = pool
+
+    async def start(self):
+        await self.pool.warm_up()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def list_tools(self) -> list:
+        return await self.pool.list_tools()
+
+    async def call_tool(self, name: str, arguments: dict = None) -> str:
+        result = await self.pool.call_tool(name, arguments)
+        return result.content[0].text if result.content else "{}"
+
+class DirectGraphBackend:
+    """
+    Ті самі інструменти falkordb-service, викликані в цьому процесі.
+    main.py завантажується з service_path і працює з FalkorDB власним redis.asyncio-пулом,
+    тож відповіді декодуються тим самим кодом, але без SSE-хопу та JSON-RPC обгортки.
+    Для розгортань, де провайдер має прямий доступ до FalkorDB (FALKORDB_HOST/FALKORDB_PORT).
+    Кеш результатів сервісу звіряється з лічильниками змін у Redis, тому записи
+    через grynya-mcp-server і через цей бекенд бачать одне одного.
+    """
+    name = "direct"
+
+    def __init__(self, service_path: str):
+        self.service_path = os.path.normpath(service_path)
+        self._module = None
+        self._lifespan = None
+        self._tools = None
+
+    def _load(self):
+        if self._module is None:
+            import importlib.util
+            path = os.path.join(self.service_path, "main.py")
+            spec = importlib.util.spec_from_file_location("grynya_service", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            self._module = module
+            logger.info(f"[graph_backend] Loaded falkordb-service tools from {path}")
+        return self._module
+
+    async def start(self):
+        if self._lifespan is not None:
+            return
+        try:
+            module = self._load()
+            lifespan = module.lifespan(module.app)
+            await lifespan.__aenter__()
+            self._lifespan = lifespan
+        except Exception as e:
+            logger.error(f"[graph_backend] Direct backend startup failed: {e}")
+
+    async def close(self):
+        if self._lifespan is not None:
+            lifespan, self._lifespan = self._lifespan, None
+            await lifespan.__aexit__(None, None, None)
+
+    async def list_tools(self) -> list:
+        if self._tools is None:
+            self._tools = await self._load().mcp.list_tools()
+        return self._tools
+
+    async def call_tool(self, name: str, arguments: dict = None) -> str:
+        if name not in {t.name for t in await self.list_tools()}:
+            return json.dumps({"status": "error", "message": f"Unknown tool: {name}"})
+        try:
+            result = getattr(self._module, name)(**(arguments or {}))
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except Exception as e:
+            return json.dumps({"status": "error", "message": str(e)})
+
+def create_graph_backend(kind: str):
+    if kind == "mcp":
+        return McpGraphBackend(grynya_pool)
+    if kind == "direct":
+        return DirectGraphBackend(GRYNYA_SERVICE_PATH)
+    raise ValueError(f"Unknown GRAPH_BACKEND '{kind}'. Must be 'mcp' or 'direct'.")
+
+graph_backend = create_graph_backend(GRAPH_BACKEND)
+
+# --- Shared LLM HTTP Client ---
+
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "1") == "1"
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "120"))
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1") == "1"
+
+http_client = None
+openai_client = None
+
+def get_http_client():
+    """
+    Спільний httpx.AsyncClient для Gemini та OpenAI: keep-alive, обмежений пул,
+    HTTP/2 якщо встановлено h2. Створюється ліниво, закривається в lifespan.
+    """
+    global http_client, openai_client
+    if http_client is None or http_client.is_closed:
+        import httpx
+        import importlib.util
+        http2 = LLM_HTTP2 and importlib.util.find_spec("h2") is not None
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        )
+        # AsyncOpenAI тримає посилання на старий клієнт — перестворюємо
+        openai_client = None
+        logger.info(f"[http_client] Created shared LLM HTTP client (http2={http2})")
+    return http_client
+
+def get_openai_client():
+    """AsyncOpenAI поверх спільного http_client; None якщо OPENAI_API_KEY не налаштований."""
+    global openai_client
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    client = get_http_client()
+    if openai_client is None:
+        from openai import AsyncOpenAI
+        # Повторами керує call_with_retries, а не SDK
+        openai_client = AsyncOpenAI(api_key=api_key, http_client=client, max_retries=0)
+    return openai_client
+
+async def close_http_client():
+    global http_client, openai_client
+    client, http_client, openai_client = http_client, None, None
+    if client is not None:
+        await client.aclose()
+
+# --- LLM Retry Policy ---
+
+LLM_RETRY_ATTEMPTS = int(os.environ.get("LLM_RETRY_ATTEMPTS", "5"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "30"))
+LLM_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Запитів на хвилину[/burst] на модель або провайдера: "gemini=60,gemini-2.5-pro=10/2"
+LLM_RATE_LIMITS = os.environ.get("LLM_RATE_LIMITS", "")
+# Запасна модель того самого провайдера: "gemini-2.5-pro=gemini-2.5-flash,gemini-2.5-flash=gemini-2.5-flash-lite"
+LLM_FALLBACK_MODELS = os.environ.get("LLM_FALLBACK_MODELS", "")
+LLM_FALLBACK_AFTER = int(os.environ.get("LLM_FALLBACK_AFTER", "2"))
+
+class LLMRetryableError(Exception):
+    """429/5xx або мережевий збій, після якого виклик варто повторити."""
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def parse_retry_after(value: str):
+    """Retry-After у секундах або як HTTP-дата; None, якщо заголовка немає."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        import datetime
+        from email.utils import parsedate_to_datetime
+        return max((parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def raise_if_retryable(status_code: int, headers, body: str = ""):
+    if status_code in LLM_RETRY_STATUSES:
+        raise LLMRetryableError(
+            f"HTTP {status_code}: {body[:200]}",
+            status=status_code,
+            retry_after=parse_retry_after(headers.get("retry-after"))
+        )
+
+def normalise_model(model: str) -> str:
+    return model[len("models/"):] if model.startswith("models/") else model
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Забирає один токен; повертає, скільки секунд довелося чекати."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+class LLMRateLimiter:
+    """Token bucket на модель (точна назва) або провайдера з LLM_RATE_LIMITS; без запису — без обмеження."""
+    def __init__(self, spec: str):
+        self.buckets: dict[str, TokenBucket] = {}
+        for item in spec.split(","):
+            if "=" not in item:
+                continue
+            key, value = item.split("=", 1)
+            rpm, _, burst = value.partition("/")
+            rate = float(rpm) / 60
+            self.buckets[key.strip()] = TokenBucket(rate, float(burst) if burst else max(1.0, rate))
+        self.waits = 0
+        self.wait_total = 0.0
+
+    async def acquire(self, model: str):
+        bucket = self.buckets.get(model) or self.buckets.get(model_provider(model))
+        if bucket is None:
+            return
+        waited = await bucket.acquire()
+        if waited:
+            self.waits += 1
+            self.wait_total += waited
+
+def parse_fallbacks(spec: str) -> dict:
+    fallbacks = {}
+    for item in spec.split(","):
+        if "=" in item:
+            model, fallback = item.split("=", 1)
+            fallbacks[normalise_model(model.strip())] = normalise_model(fallback.strip())
+    return fallbacks
+
+rate_limiter = LLMRateLimiter(LLM_RATE_LIMITS)
+LLM_FALLBACKS = parse_fallbacks(LLM_FALLBACK_MODELS)
+retry_stats = {"retries": 0, "fallbacks": 0, "exhausted": 0}
+
+async def call_with_retries(model: str, attempt, label: str = "llm"):
+    """
+    Викликає attempt(model) з повторами на LLMRetryableError (до LLM_RETRY_ATTEMPTS спроб).
+    Пауза — Retry-After від сервера або експоненційний backoff з jitter, не більше LLM_RETRY_MAX_DELAY.
+    Перед кожною спробою чекає на token bucket; після LLM_FALLBACK_AFTER невдач поспіль
+    переходить на запасну модель з LLM_FALLBACK_MODELS.
+    """
+    current = normalise_model(model)
+    failures = 0
+    for attempt_no in range(1, LLM_RETRY_ATTEMPTS + 1):
+        await rate_limiter.acquire(current)
+        try:
+            return await attempt(current)
+        except LLMRetryableError as e:
+            if attempt_no == LLM_RETRY_ATTEMPTS:
+                retry_stats["exhausted"] += 1
+                raise
+            failures += 1
+            retry_stats["retries"] += 1
+            if e.retry_after is not None:
+                delay = min(e.retry_after, LLM_RETRY_MAX_DELAY)
+            else:
+                delay = min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (failures - 1))
+                delay = random.uniform(delay / 2, delay)
+            fallback = LLM_FALLBACKS.get(current)
+            if fallback and failures >= LLM_FALLBACK_AFTER:
+                print(f"[{label}] {current} failed {failures} times in a row ({e}), falling back to {fallback}")
+                retry_stats["fallbacks"] += 1
+                current = fallback
+                failures = 0
+                # Retry-After стосувався попередньої моделі
+                delay = 0.0
+            print(f"[{label}] Retryable error: {e}. Attempt {attempt_no}/{LLM_RETRY_ATTEMPTS}, retrying {current} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def gemini_url(model: str, method: str) -> str:
+    return f"{GEMINI_API_BASE}/models/{normalise_model(model)}:{method}"
+
+async def _gemini_post(model: str, method: str, headers: dict, payload: dict):
+    import httpx
+    try:
+        response = await get_http_client().post(gemini_url(model, method), headers=headers, json=payload)
+    except httpx.TransportError as e:
+        raise LLMRetryableError(f"{type(e).__name__}: {e}") from e
+    raise_if_retryable(response.status_code, response.headers, response.text)
+    return response
+
+def openai_retryable(e: Exception):
+    """LLMRetryableError для 429/5xx та мережевих помилок OpenAI SDK, інакше None."""
+    import openai
+    if isinstance(e, openai.APIStatusError) and e.status_code in LLM_RETRY_STATUSES:
+        return LLMRetryableError(
+            f"HTTP {e.status_code}: {e.message}",
+            status=e.status_code,
+            retry_after=parse_retry_after(e.response.headers.get("retry-after"))
+        )
+    if isinstance(e, openai.APIConnectionError):
+        return LLMRetryableError(f"{type(e).__name__}: {e}")
+    return None
+
+_provider_started = False
+_warm_up_task = None
+
+def _log_warm_up(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"[lifespan] Graph backend warm-up failed: {task.exception()!r}")
+
+@asynccontextmanager
+async def provider_lifespan(server):
+    """
+    Прогріває графовий бекенд і реєстр скілів при першому підключенні.
+    FastMCP входить у lifespan на кожне SSE-підключення, а фонові задачі переживають клієнта,
+    тому спільні клієнт і пул живуть до зупинки процесу (див. shutdown_provider).
+    """
+    global _provider_started, _warm_up_task
+    if not _provider_started:
+        _provider_started = True
+        # Посилання тримаємо, щоб задачу не зібрав GC, а помилка потрапила в лог
+        _warm_up_task = asyncio.create_task(graph_backend.start())
+        _warm_up_task.add_done_callback(_log_warm_up)
+        gemini_credentials.start()
+        skill_registry.load_all()
+    yield {"graph_backend": graph_backend}
+
+async def shutdown_provider():
+    """Закриває спільні з'єднання при зупинці процесу."""
+    global _provider_started
+    if not _provider_started:
+        return
+    _provider_started = False
+    gemini_credentials.stop()
+    await graph_backend.close()
+    await close_http_client()
+
+async def serve(**kwargs):
+    """Запускає сервер і звільняє спільні ресурси в тому ж event loop після його зупинки."""
+    try:
+        await mcp.run_async(**kwargs)
+    finally:
+        await shutdown_provider()
+
+from fastmcp import FastMCP, Context
 # Create the MCP server
-mcp = FastMCP("llm-provider-mcp")
+mcp = FastMCP("llm-provider-mcp", lifespan=provider_lifespan)
 
-def call_gemini(prompt: str, system_prompt: str, model: str, tools_info: str = None) -> str:
-    from google import genai
-    from google.genai import types
-    from google.oauth2.credentials import Credentials
-    import os
-    
+async def _gemini_stream(model: str, headers: dict, payload: dict, on_delta) -> str:
+    """:streamGenerateContent?alt=sse — кожен SSE-подія передає наступний фрагмент тексту в on_delta."""
+    import httpx
+
+    async def attempt(m: str) -> str:
+        chunks = []
+        try:
+            url = gemini_url(m, "streamGenerateContent") + "?alt=sse"
+            async with get_http_client().stream("POST", url, headers=headers, json=payload) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode(errors="replace")
+                    raise_if_retryable(response.status_code, response.headers, body)
+                    return f"Error: Gemini API returned status {response.status_code}: {body}"
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = json.loads(line[5:])
+                    candidates = data.get("candidates") or [{}]
+                    parts = candidates[0].get("content", {}).get("parts", [])
+                    text = "".join(p.get("text", "") for p in parts)
+                    if text:
+                        chunks.append(text)
+                        on_delta(text)
+        except httpx.TransportError as e:
+            # Після першого фрагмента повтор задублював би вже відданий текст
+            if chunks:
+                raise
+            raise LLMRetryableError(f"{type(e).__name__}: {e}") from e
+        return "".join(chunks)
+
+    return await call_with_retries(model, attempt, "call_gemini")
+
+async def call_gemini(prompt: str, system_prompt: str, model: str, tools_info: str = None, on_delta=None) -> str:
+    """on_delta(text) — отримує фрагменти відповіді, якщо увімкнено LLM_STREAMING."""
     print("[call_gemini] Entering Gemini API wrapper")
-    token_path = os.environ.get("GEMINI_TOKEN_PATH", "credentials/token.json")
-    
-    if not os.path.exists(token_path):
-        return f"Error: Token file not found at {token_path}. Please generate it via OAuth and place it in the credentials folder."
-        
     try:
-        from google.auth.transport.requests import Request
-        import requests
-        
-        creds = Credentials.from_authorized_user_file(token_path)
-        if not creds.valid:
-            if creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+        token = await gemini_credentials.get_token()
             
-        if not model.startswith("models/"):
-            full_model_name = f"models/{model}"
-        else:
-            full_model_name = model
-
         print(f"[call_gemini] Using direct REST API request with Bearer token.")
         
-        url = f"https://generativelanguage.googleapis.com/v1beta/{full_model_name}:generateContent"
         headers = {
-            "Authorization": f"Bearer {creds.token}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
         
@@ -112,8 +981,16 @@ def call_gemini(prompt: str, system_prompt: str, model: str, tools_info: str = N
             "parts": [{"text": final_prompt}]
         }]
             
+        if on_delta and LLM_STREAMING:
+            print(f"[call_gemini] Streaming response from Gemini {model}...")
+            text = await _gemini_stream(model, headers, payload, on_delta)
+            print("[call_gemini] Gemini stream finished.")
+            return text
+
         print(f"[call_gemini] Sending request to Gemini {model}... This might take a while.")
-        response = requests.post(url, headers=headers, json=payload)
+        response = await call_with_retries(
+            model, lambda m: _gemini_post(m, "generateContent", headers, payload), "call_gemini"
+        )
         
         if response.status_code != 200:
             return f"Error: Gemini API returned status {response.status_code}: {response.text}"
@@ -127,32 +1004,50 @@ def call_gemini(prompt: str, system_prompt: str, model: str, tools_info: str = N
             return text
         else:
             return f"Returned unexpected format: {data}"
+    except FileNotFoundError:
+        return f"Error: Token file not found at {GEMINI_TOKEN_PATH}. Please generate it via OAuth and place it in the credentials folder."
     except Exception as e:
         print(f"[call_gemini] Encountered an error: {str(e)}")
         import traceback
         traceback.print_exc()
         return f"Gemini API Error: {str(e)}"
 
-def call_openai(prompt: str, system_prompt: str, model: str) -> str:
-    from openai import OpenAI
-    
+async def call_openai(prompt: str, system_prompt: str, model: str, on_delta=None) -> str:
+    """on_delta(text) — отримує фрагменти відповіді, якщо увімкнено LLM_STREAMING."""
     print("[call_openai] Entering OpenAI API wrapper")
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    client = get_openai_client()
+    if client is None:
         return "Error: OPENAI_API_KEY not configured."
         
-    client = OpenAI(api_key=api_key)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": prompt})
+
+    async def create(m: str, **kwargs):
+        try:
+            return await client.chat.completions.create(model=m, messages=messages, **kwargs)
+        except Exception as e:
+            retryable = openai_retryable(e)
+            if retryable is None:
+                raise
+            raise retryable from e
     
     try:
+        if on_delta and LLM_STREAMING:
+            print(f"[call_openai] Streaming response from OpenAI {model}...")
+            stream = await call_with_retries(model, lambda m: create(m, stream=True), "call_openai")
+            chunks = []
+            async for chunk in stream:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    chunks.append(text)
+                    on_delta(text)
+            print("[call_openai] OpenAI stream finished.")
+            return "".join(chunks)
+
         print(f"[call_openai] Sending request to OpenAI {model}... This might take a while.")
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        response = await call_with_retries(model, create, "call_openai")
         print("[call_openai] Received response from OpenAI API.")
         return response.choices[0].message.content
     except Exception as e:
@@ -162,72 +1057,541 @@ def call_openai(prompt: str, system_prompt: str, model: str) -> str:
         return f"OpenAI API Error: {str(e)}"
 
 SKILLS_DIR = os.path.join(os.path.dirname(__file__), "..", ".gemini", "antigravity", "skills")
+# Як часто (с) перевіряти mtime SKILL.md; між перевірками скіл віддається з пам'яті
+SKILL_STAT_INTERVAL = float(os.environ.get("SKILL_STAT_INTERVAL", "2"))
+
+FALLBACK_SKILL_PROMPT = (
+    "You are a graph research agent. Use query_graph tool to search FalkorDB. "
+    "MANDATORY: call query_graph at least once. Start with: "
+    "MATCH (n) RETURN labels(n) AS type, count(n) AS cnt ORDER BY cnt DESC. "
+    "Return valid JSON: {\"summary\": \"...\", \"found_nodes\": [], "
+    "\"graphs_searched\": [], \"queries_executed\": [], \"is_empty\": true/false}"
+)
+
+def parse_skill_file(content: str) -> tuple[dict, str]:
+    """Розділяє SKILL.md на frontmatter (--- key: value ---) та тіло інструкцій."""
+    if not content.startswith("---"):
+        return {}, content
+    parts = content.split("---", 2)
+    if len(parts) < 3:
+        return {}, content
+    meta = {}
+    for line in parts[1].splitlines():
+        key, sep, value = line.partition(":")
+        if sep and key.strip() and not line[0].isspace():
+            meta[key.strip()] = value.strip().strip("\"'")
+    return meta, parts[2].strip()
+
+@dataclass
+class Skill:
+    name: str
+    path: str
+    mtime_ns: int
+    size: int
+    meta: dict
+    body: str
+
+class SkillRegistry:
+    """
+    Реєстр скілів: усі SKILL.md читаються при старті, розібрані frontmatter і тіло
+    тримаються в пам'яті. Зміну файлу видно за mtime/розміром (stat не частіше
+    SKILL_STAT_INTERVAL), після чого скіл перечитується.
+    """
+    def __init__(self, root: str, stat_interval: float):
+        self.root = root
+        self.stat_interval = stat_interval
+        self._skills: dict[str, Skill] = {}
+        self._checked: dict[str, float] = {}
+        self.loads = 0
+        self.hits = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.normpath(os.path.join(self.root, name, "SKILL.md"))
+
+    def _load(self, name: str, path: str, st: os.stat_result) -> Skill:
+        with open(path, "r", encoding="utf-8") as f:
+            meta, body = parse_skill_file(f.read())
+        skill = Skill(name, path, st.st_mtime_ns, st.st_size, meta, body)
+        self._skills[name] = skill
+        self.loads += 1
+        print(f"[skills] Loaded skill '{name}' from {path}")
+        return skill
+
+    def get(self, name: str):
+        """Скіл з пам'яті; перечитує SKILL.md, якщо файл змінився. None — скілу немає."""
+        skill = self._skills.get(name)
+        now = time.monotonic()
+        if skill is not None and now - self._checked.get(name, 0) < self.stat_interval:
+            self.hits += 1
+            return skill
+        self._checked[name] = now
+        path = self._path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._skills.pop(name, None)
+            return None
+        if skill is not None and (skill.mtime_ns, skill.size) == (st.st_mtime_ns, st.st_size):
+            self.hits += 1
+            return skill
+        return self._load(name, path, st)
+
+    def load_all(self) -> list[Skill]:
+        """Сканує SKILLS_DIR: підвантажує нові/змінені скіли, забуває видалені."""
+        try:
+            names = sorted(
+                entry.name for entry in os.scandir(self.root)
+                if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "SKILL.md"))
+            )
+        except OSError:
+            names = []
+        for name in set(self._skills) - set(names):
+            self._skills.pop(name, None)
+        self._checked.clear()
+        return [skill for skill in map(self.get, names) if skill is not None]
+
+    def stats(self) -> dict:
+        return {"skills": len(self._skills), "loads": self.loads, "hits": self.hits}
+
+skill_registry = SkillRegistry(SKILLS_DIR, SKILL_STAT_INTERVAL)
 
 def load_skill(skill_name: str) -> str:
     """
-    Завантажує вміст SKILL.md з папки .gemini/antigravity/skills/<skill_name>/.
-    Повертає текст скілу або fallback-промпт якщо файл не знайдено.
-    """
-    skill_path = os.path.join(SKILLS_DIR, skill_name, "SKILL.md")
-    skill_path = os.path.normpath(skill_path)
-    if os.path.exists(skill_path):
-        with open(skill_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        print(f"[load_skill] Loaded skill '{skill_name}' from {skill_path}")
-        # Strip YAML frontmatter (--- ... ---) — передаємо тільки тіло інструкцій
-        if content.startswith("---"):
-            parts = content.split("---", 2)
-            if len(parts) >= 3:
-                content = parts[2].strip()
-        return content
-    else:
-        print(f"[load_skill] Skill '{skill_name}' not found at {skill_path}, using fallback.")
-        return (
-            "You are a graph research agent. Use query_graph tool to search FalkorDB. "
-            "MANDATORY: call query_graph at least once. Start with: "
-            "MATCH (n) RETURN labels(n) AS type, count(n) AS cnt ORDER BY cnt DESC. "
-            "Return valid JSON: {\"summary\": \"...\", \"found_nodes\": [], "
-            "\"graphs_searched\": [], \"queries_executed\": [], \"is_empty\": true/false}"
-        )
+    Тіло скілу .gemini/antigravity/skills/<skill_name>/SKILL.md з реєстру (без frontmatter).
+    Повертає fallback-промпт, якщо скіл не знайдено.
+    """
+    skill = skill_registry.get(skill_name)
+    if skill is None:
+        print(f"[load_skill] Skill '{skill_name}' not found at {skill_registry._path(skill_name)}, using fallback.")
+        return FALLBACK_SKILL_PROMPT
+    return skill.body
+
+GEMINI_TOKEN_PATH = os.environ.get("GEMINI_TOKEN_PATH", "credentials/token.json")
+GEMINI_REFRESH_MARGIN = float(os.environ.get("GEMINI_REFRESH_MARGIN", "300"))
 
-def _get_gemini_credentials():
-    from google.oauth2.credentials import Credentials
-    from google.auth.transport.requests import Request
-    token_path = os.environ.get("GEMINI_TOKEN_PATH", "credentials/token.json")
-    if not os.path.exists(token_path):
-        raise FileNotFoundError(f"Token file not found at {token_path}")
-    creds = Credentials.from_authorized_user_file(token_path)
-    if not creds.valid and creds.expired and creds.refresh_token:
+class GeminiCredentials:
+    """
+    OAuth-токен Gemini на весь процес: token.json читається один раз, далі get_token()
+    віддає bearer-токен з пам'яті без дискового I/O. Оновлення — у фоні за
+    GEMINI_REFRESH_MARGIN секунд до закінчення, під asyncio.Lock (один запит до token endpoint
+    на всі задачі); оновлений токен атомарно записується назад у token.json.
+    """
+    def __init__(self, token_path: str, margin: float):
+        self.token_path = token_path
+        self.margin = margin
+        self.creds = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        self._loop_task = None
+        self.loads = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _seconds_left(self):
+        """Секунди до закінчення токена; None, якщо строк невідомий."""
+        if self.creds is None or not self.creds.token:
+            return 0.0
+        if self.creds.expiry is None:
+            return None
+        import datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (self.creds.expiry - now).total_seconds()
+
+    def _load_sync(self):
+        from google.oauth2.credentials import Credentials
+        if not os.path.exists(self.token_path):
+            raise FileNotFoundError(f"Token file not found at {self.token_path}")
+        return Credentials.from_authorized_user_file(self.token_path)
+
+    def _refresh_sync(self, creds):
+        from google.auth.transport.requests import Request
         creds.refresh(Request())
-    return creds
+        tmp_path = f"{self.token_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(creds.to_json())
+        os.replace(tmp_path, self.token_path)
+
+    async def _ensure_fresh(self, force: bool = False):
+        async with self._lock:
+            # Інша задача могла оновити токен, поки ми чекали на lock
+            if self.creds is None:
+                self.creds = await asyncio.to_thread(self._load_sync)
+                self.loads += 1
+            left = self._seconds_left()
+            if not force and (left is None or left > self.margin):
+                return
+            if not self.creds.refresh_token:
+                return
+            try:
+                await asyncio.to_thread(self._refresh_sync, self.creds)
+                self.refreshes += 1
+                logger.info(f"[gemini_credentials] Token refreshed, valid for {self._seconds_left():.0f}s")
+            except Exception:
+                self.refresh_errors += 1
+                # Наступна спроба перечитає token.json — його могли перевипустити через auth.py
+                self.creds = None
+                raise
+
+    def _refresh_in_background(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self):
+        try:
+            await self._ensure_fresh()
+        except Exception as e:
+            logger.error(f"[gemini_credentials] Background refresh failed: {e}")
+
+    async def get_token(self) -> str:
+        left = self._seconds_left()
+        if left is None or left > self.margin:
+            return self.creds.token
+        if left > 0:
+            # Токен ще дійсний — віддаємо його, оновлення йде у фоні
+            self._refresh_in_background()
+            return self.creds.token
+        await self._ensure_fresh()
+        return self.creds.token
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self._ensure_fresh()
+                left = self._seconds_left()
+                delay = 3600 if left is None else max(left - self.margin, 5)
+            except FileNotFoundError:
+                delay = 60
+            except Exception as e:
+                logger.error(f"[gemini_credentials] Refresh failed: {e}")
+                delay = 30
+            await asyncio.sleep(delay)
+
+    def start(self):
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+
+    def stats(self) -> dict:
+        left = self._seconds_left()
+        return {
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "seconds_left": round(left, 1) if left is not None else None
+        }
+
+gemini_credentials = GeminiCredentials(GEMINI_TOKEN_PATH, GEMINI_REFRESH_MARGIN)
+
+GEMINI_CONTEXT_CACHE = os.environ.get("GEMINI_CONTEXT_CACHE", "1") == "1"
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", "3600"))
+# Gemini не кешує замалі префікси (мінімум 1-4k токенів залежно від моделі), їх передаємо inline
+GEMINI_CACHE_MIN_CHARS = int(os.environ.get("GEMINI_CACHE_MIN_CHARS", "4096"))
+GEMINI_CACHE_RETRY_AFTER = 300
+# Кешування ранніх ходів агентного циклу: префікс розмови переноситься в cachedContents,
+# коли ще не закешована частина перевищує GEMINI_CACHE_ROLL_CHARS
+GEMINI_CACHE_CONVERSATION = os.environ.get("GEMINI_CACHE_CONVERSATION", "0") == "1"
+GEMINI_CACHE_ROLL_CHARS = int(os.environ.get("GEMINI_CACHE_ROLL_CHARS", "16000"))
+GEMINI_CONVERSATION_CACHE_TTL = int(os.environ.get("GEMINI_CONVERSATION_CACHE_TTL", "600"))
+
+class GeminiContextCache:
+    """
+    Кеш Gemini cachedContents: стабільний префікс запиту (systemInstruction, tools)
+    завантажується один раз і далі передається посиланням cachedContent.
+    Ключ — (модель, sha256 префікса), тож змінений скіл отримує новий запис;
+    запис оновлюється до завершення TTL, невдале створення не повторюється
+    GEMINI_CACHE_RETRY_AFTER секунд.
+    """
+    def __init__(self, ttl: int, min_chars: int):
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self._entries: dict[tuple, tuple] = {}  # key -> (name | None, valid_until)
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        self.created = 0
+        self.hits = 0
+        self.failures = 0
+
+    async def get(self, model: str, headers: dict, prefix: dict, ttl: int = None):
+        """Ім'я cachedContents/... для префікса або None, якщо його треба передати inline."""
+        if not GEMINI_CONTEXT_CACHE:
+            return None
+        encoded = json.dumps(prefix, sort_keys=True, ensure_ascii=False)
+        if len(encoded) < self.min_chars:
+            return None
+        ttl = ttl or self.ttl
+        key = (normalise_model(model), hashlib.sha256(encoded.encode()).hexdigest())
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += entry[0] is not None
+            return entry[0]
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += entry[0] is not None
+                return entry[0]
+            try:
+                response = await get_http_client().post(
+                    f"{GEMINI_API_BASE}/cachedContents",
+                    headers=headers,
+                    json={"model": f"models/{key[0]}", "ttl": f"{ttl}s", **prefix}
+                )
+                response.raise_for_status()
+                name = response.json()["name"]
+                self._entries[key] = (name, time.monotonic() + max(ttl - 60, ttl / 2))
+                self.created += 1
+                print(f"[context_cache] Created {name} for {key[0]} ({len(encoded)} chars)")
+            except Exception as e:
+                name = None
+                self._entries[key] = (None, time.monotonic() + GEMINI_CACHE_RETRY_AFTER)
+                self.failures += 1
+                logger.warning(f"[context_cache] cachedContents create failed, sending prefix inline: {e}")
+        self._locks.pop(key, None)
+        self._prune()
+        return name
+
+    def invalidate(self, name: str):
+        """Кеш, який Gemini вже не приймає: префікс іде inline, повторне створення — через GEMINI_CACHE_RETRY_AFTER."""
+        for key in [k for k, (n, _) in self._entries.items() if n == name]:
+            self._entries[key] = (None, time.monotonic() + GEMINI_CACHE_RETRY_AFTER)
+
+    def alive(self, name: str) -> bool:
+        return any(n == name for n, _ in self._entries.values())
+
+    async def delete(self, name: str, headers: dict):
+        """Видаляє одноразовий кеш (префікс розмови), щоб не платити за його зберігання до TTL."""
+        for key in [k for k, (n, _) in self._entries.items() if n == name]:
+            del self._entries[key]
+        try:
+            await get_http_client().delete(f"{GEMINI_API_BASE}/{name}", headers=headers)
+        except Exception as e:
+            logger.warning(f"[context_cache] Failed to delete {name}: {e}")
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [k for k, (_, until) in self._entries.items() if until <= now]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        return {
+            "entries": sum(1 for name, _ in self._entries.values() if name),
+            "created": self.created,
+            "hits": self.hits,
+            "failures": self.failures
+        }
 
-def _gemini_api_call(url: str, headers: dict, payload: dict) -> dict:
-    """Синхронний HTTP виклик до Gemini API — запускається через asyncio.to_thread."""
-    import requests as http_requests
-    response = http_requests.post(url, headers=headers, json=payload, timeout=60)
+gemini_context_cache = GeminiContextCache(GEMINI_CACHE_TTL, GEMINI_CACHE_MIN_CHARS)
+
+# Сумарні розміри запитів і токени агентних циклів (provider_stats)
+agent_loop_totals = {
+    "iterations": 0, "request_bytes": 0, "inline_bytes": 0,
+    "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0
+}
+
+def json_size(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False))
+
+def record_loop_usage(usage_log, iteration: int, request_bytes: int, inline_bytes: int,
+                      cached_turns: int, data: dict, elapsed: float):
+    """
+    Запис однієї ітерації агентного циклу: байти запиту фактичні та без кешу (inline),
+    скільки ходів узято з cachedContents і usageMetadata відповіді Gemini.
+    """
+    meta = data.get("usageMetadata", {})
+    entry = {
+        "iteration": iteration,
+        "request_bytes": request_bytes,
+        "inline_bytes": inline_bytes,
+        "cached_turns": cached_turns,
+        "prompt_tokens": meta.get("promptTokenCount", 0),
+        "cached_tokens": meta.get("cachedContentTokenCount", 0),
+        "output_tokens": meta.get("candidatesTokenCount", 0),
+        "elapsed": round(elapsed, 3)
+    }
+    agent_loop_totals["iterations"] += 1
+    for name in ("request_bytes", "inline_bytes", "prompt_tokens", "cached_tokens", "output_tokens"):
+        agent_loop_totals[name] += entry[name]
+    if usage_log is not None:
+        usage_log.append(entry)
+    print(
+        f"[agentic_loop] Usage #{iteration}: {request_bytes}/{inline_bytes} bytes sent/inline, "
+        f"prompt={entry['prompt_tokens']} cached={entry['cached_tokens']} output={entry['output_tokens']} tokens"
+    )
+
+def summarise_loop_usage(usage_log: list) -> dict:
+    summary = {"iterations": len(usage_log)}
+    for name in ("request_bytes", "inline_bytes", "prompt_tokens", "cached_tokens", "output_tokens"):
+        summary[name] = sum(entry[name] for entry in usage_log)
+    return summary
+
+async def _gemini_api_call(model: str, headers: dict, payload: dict, inline: dict = None) -> dict:
+    """
+    HTTP виклик до Gemini API через спільний keep-alive клієнт з повторами (call_with_retries).
+    inline — префікс, який замінює cachedContent для fallback-моделі (кеш прив'язаний до моделі)
+    або коли Gemini відкинув прострочений кеш.
+    """
+    def without_cache(body: dict) -> dict:
+        body = {k: v for k, v in body.items() if k != "cachedContent"}
+        body.update(inline)
+        return body
+
+    def attempt(m: str):
+        body = payload
+        if inline and "cachedContent" in body and normalise_model(m) != normalise_model(model):
+            body = without_cache(body)
+        return _gemini_post(m, "generateContent", headers, body)
+
+    response = await call_with_retries(model, attempt, "agentic_loop")
+    if inline and "cachedContent" in payload and response.status_code in (400, 403, 404):
+        print(f"[agentic_loop] Cached content rejected ({response.status_code}), resending prefix inline")
+        gemini_context_cache.invalidate(payload["cachedContent"])
+        payload = without_cache(payload)
+        response = await call_with_retries(model, attempt, "agentic_loop")
     response.raise_for_status()
     return response.json()
 
 
+AGENT_TOOL_CONCURRENCY = int(os.environ.get("AGENT_TOOL_CONCURRENCY", "4"))
+AGENT_TOOL_TIMEOUT = float(os.environ.get("AGENT_TOOL_TIMEOUT", "60"))
+# Бюджети в символах JSON (~4 символи на токен): на один результат query_graph
+# і на всі functionResponse розмови — понад нього старі відповіді згортаються до підсумку
+AGENT_RESULT_MAX_CHARS = int(os.environ.get("AGENT_RESULT_MAX_CHARS", "20000"))
+AGENT_CONTEXT_MAX_CHARS = int(os.environ.get("AGENT_CONTEXT_MAX_CHARS", "80000"))
+RESULT_TRUNCATION_HINT = (
+    "Result truncated. Refine the query instead of fetching everything: filter with WHERE, "
+    "return specific properties instead of whole nodes, aggregate with count(), or add LIMIT."
+)
+
+def _truncate_text(result_text: str, max_chars: int) -> str:
+    # Запас під позначку й підказку, щоб разом з ними текст не вийшов за max_chars
+    keep = max(0, max_chars - len(RESULT_TRUNCATION_HINT) - 50)
+    return f"{result_text[:keep]}... [truncated {len(result_text) - keep} chars] {RESULT_TRUNCATION_HINT}"
+
+def _clip_value(value, max_chars: int):
+    """Вкорочує рядки та списки всередині одного рядка результату, щоб він уміщався в max_chars."""
+    if isinstance(value, str):
+        if len(value) <= max_chars:
+            return value
+        return f"{value[:max(0, max_chars - 40)]}... [truncated {len(value)} chars]"
+    if isinstance(value, list):
+        items, size = [], 0
+        for item in value:
+            item = _clip_value(item, max(0, max_chars - size - 40))
+            size += json_size(item) + 2
+            if size > max_chars - 40:
+                break
+            items.append(item)
+        if len(items) < len(value):
+            items.append(f"... [{len(value) - len(items)} more items]")
+        return items
+    if isinstance(value, dict):
+        share = max_chars // max(1, len(value))
+        return {k: _clip_value(v, max(0, share - len(str(k)) - 6)) for k, v in value.items()}
+    return value
+
+def _fit_rows(rows: list, max_chars: int) -> list:
+    kept, size = [], 0
+    for row in rows:
+        size += json_size(row) + 2
+        if kept and size > max_chars:
+            break
+        kept.append(row)
+    if kept and json_size(kept) > max_chars:
+        # Лишився один рядок, більший за весь бюджет (collect(n), довгий текст) — вкорочуємо його значення
+        kept = [_clip_value(kept[0], max_chars)]
+    return kept
+
+def truncate_tool_result(result_text: str, max_chars: int) -> str:
+    """
+    Обмежує результат query_graph для functionResponse: лишає перші рядки, що вміщаються
+    в max_chars, додає returned_rows/total_rows і підказку уточнити запит.
+    Підказка додається й тоді, коли сервіс сам обрізав сторінку (є cursor).
+    """
+    try:
+        data = json.loads(result_text)
+    except (json.JSONDecodeError, TypeError):
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("results"), (list, dict)):
+        if len(result_text) <= max_chars:
+            return result_text
+        return _truncate_text(result_text, max_chars)
+
+    results = data["results"]
+    truncated = bool(data.get("cursor") or data.get("cursors"))
+    if len(result_text) > max_chars:
+        # Запас під status/total_rows/hint, щоб підсумковий JSON не вийшов за max_chars
+        rows_budget = max(0, max_chars - len(RESULT_TRUNCATION_HINT) - 200)
+        if isinstance(results, list):
+            data["results"] = _fit_rows(results, rows_budget)
+            data["total_rows"] = data.get("total_rows") or len(results)
+            data["returned_rows"] = len(data["results"])
+        else:
+            # Кілька графів — бюджет ділиться порівну між ними
+            share = rows_budget // max(1, len(results))
+            for graph_name, rows in results.items():
+                if isinstance(rows, list):
+                    results[graph_name] = _fit_rows(rows, share)
+        truncated = True
+    if not truncated:
+        return result_text
+    data["truncated"] = True
+    data["hint"] = RESULT_TRUNCATION_HINT
+    output = json.dumps(data, ensure_ascii=False)
+    if len(output) > max_chars:
+        # Вкорочені значення все ще не вмістилися — віддаємо початок тексту з підказкою
+        return _truncate_text(result_text, max_chars)
+    return output
+
+def summarise_tool_result(query: str, result_text: str) -> str:
+    """Короткий підсумок результату, яким замінюється стара functionResponse понад бюджет розмови."""
+    summary = {"collapsed": True, "query": query[:300]}
+    try:
+        data = json.loads(result_text)
+    except (json.JSONDecodeError, TypeError):
+        data = None
+    if isinstance(data, dict):
+        summary["status"] = data.get("status")
+        results = data.get("results")
+        if isinstance(results, list):
+            summary["rows"] = len(results)
+            if isinstance(data.get("total_rows"), int):
+                summary["total_rows"] = data["total_rows"]
+            if results and isinstance(results[0], dict):
+                summary["columns"] = list(results[0])
+        elif isinstance(results, dict):
+            summary["rows"] = {g: len(rows) if isinstance(rows, list) else rows for g, rows in results.items()}
+        if data.get("message"):
+            summary["message"] = str(data["message"])[:300]
+    summary["note"] = "Earlier result collapsed to save context; re-run the query if you need the rows again."
+    return json.dumps(summary, ensure_ascii=False)
+
 async def call_gemini_agentic_loop(
     prompt: str,
     system_prompt: str,
     model: str,
-    falkordb_session,
-    max_iterations: int = 10
+    graph_backend,
+    max_iterations: int = 10,
+    usage_log: list = None
 ) -> tuple[str, list[str], list[str]]:
     """
     Запускає Gemini у агентному циклі з Function Calling для query_graph.
-    HTTP-виклики до Gemini виконуються через asyncio.to_thread (не блокують event loop).
+    graph_backend — McpGraphBackend або DirectGraphBackend (див. GRAPH_BACKEND).
+    HTTP-виклики до Gemini йдуть через спільний async-клієнт (get_http_client) з keep-alive.
+    Системна інструкція й tools передаються через cachedContents (gemini_context_cache), якщо префікс достатньо великий;
+    з GEMINI_CACHE_CONVERSATION=1 туди ж переносяться ранні ходи розмови, а в запиті лишаються лише нові.
+    usage_log — список, куди додаються байти запиту та usageMetadata кожної ітерації.
+    Кілька functionCall одного ходу виконуються паралельно (AGENT_TOOL_CONCURRENCY, AGENT_TOOL_TIMEOUT).
+    Результати обмежуються AGENT_RESULT_MAX_CHARS, а коли functionResponse розмови перевищують
+    AGENT_CONTEXT_MAX_CHARS, найстаріші з них згортаються до підсумків (summarise_tool_result).
     Повертає: (final_text, queries_executed, graphs_searched)
     """
-    creds = await asyncio.to_thread(_get_gemini_credentials)
-
-    if not model.startswith("models/"):
-        model = f"models/{model}"
+    token = await gemini_credentials.get_token()
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/{model}:generateContent"
-    headers = {"Authorization": f"Bearer {creds.token}", "Content-Type": "application/json"}
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 
     tools_declaration = [{
         "functionDeclarations": [{
@@ -251,219 +1615,290 @@ async def call_gemini_agentic_loop(
         }]
     }]
 
-    contents = [{"role": "user", "parts": [{"text": prompt}]}]
-    queries_executed = []
-    graphs_searched = set()
-    final_text = ""
-
-    for iteration in range(max_iterations):
-        payload = {"contents": contents, "tools": tools_declaration}
-        if system_prompt:
-            payload["systemInstruction"] = {"parts": [{"text": system_prompt}]}
-
-        print(f"[agentic_loop] Iteration {iteration + 1}/{max_iterations}")
-        try:
-            data = await asyncio.to_thread(_gemini_api_call, url, headers, payload)
-        except Exception as api_err:
-            print(f"[agentic_loop] Gemini API call failed: {api_err}")
-            raise
-
-        candidates = data.get("candidates", [])
-        if not candidates:
-            prompt_feedback = data.get("promptFeedback", {})
-            block_reason = prompt_feedback.get("blockReason", "UNKNOWN")
-            print(f"[agentic_loop] Empty candidates! blockReason={block_reason}, raw={json.dumps(data)[:300]}")
-            break
-
-        candidate = candidates[0]
-        content = candidate.get("content", {})
-        parts = content.get("parts", [])
-        finish_reason = candidate.get("finishReason", "STOP")
-
-        print(f"[agentic_loop] finishReason={finish_reason}, parts_count={len(parts)}")
-
-        function_calls = [p["functionCall"] for p in parts if "functionCall" in p]
-
-        if not function_calls:
-            final_text = "".join(p.get("text", "") for p in parts)
-            print(f"[agentic_loop] Final text response ({len(final_text)} chars)")
-            break
-
-        contents.append({"role": "model", "parts": parts})
-
-        function_responses = []
-        for fc in function_calls:
-            fc_name = fc["name"]
-            fc_args = fc.get("args", {})
-            cypher = fc_args.get("query", "")
-            fc_graphs = fc_args.get("graphs", None)
-
-            queries_executed.append(cypher)
-            if fc_graphs:
-                graphs_searched.update(fc_graphs)
-
+    call_slots = asyncio.Semaphore(AGENT_TOOL_CONCURRENCY)
+
+    async def run_call(fc: dict) -> dict:
+        fc_name = fc["name"]
+        fc_args = fc.get("args", {})
+        cypher = fc_args.get("query", "")
+        fc_graphs = fc_args.get("graphs", None)
+        arguments = {"query": cypher, "max_bytes": AGENT_RESULT_MAX_CHARS}
+        if fc_graphs:
+            arguments["graphs"] = fc_graphs
+        async with call_slots:
             print(f"[agentic_loop] Executing {fc_name}: {cypher[:80]}...")
             try:
-                result = await falkordb_session.call_tool(
-                    "query_graph",
-                    arguments={"query": cypher, "graphs": fc_graphs} if fc_graphs else {"query": cypher}
+                result_text = await asyncio.wait_for(
+                    graph_backend.call_tool("query_graph", arguments=arguments),
+                    AGENT_TOOL_TIMEOUT
                 )
-                result_text = result.content[0].text if result.content else "{}"
+                result_text = truncate_tool_result(result_text, AGENT_RESULT_MAX_CHARS)
+            except asyncio.TimeoutError:
+                result_text = json.dumps({"status": "error", "message": f"Query timed out after {AGENT_TOOL_TIMEOUT}s"})
             except Exception as e:
                 result_text = json.dumps({"status": "error", "message": str(e)})
+        return {
+            "functionResponse": {
+                "name": fc_name,
+                "response": {"result": result_text}
+            }
+        }
 
-            function_responses.append({
-                "functionResponse": {
-                    "name": fc_name,
-                    "response": {"result": result_text}
-                }
-            })
+    contents = [{"role": "user", "parts": [{"text": prompt}]}]
+    queries_executed = []
+    graphs_searched = set()
+    final_text = ""
 
-        contents.append({"role": "user", "parts": function_responses})
-    else:
-        final_text = f"Досягнуто ліміт ітерацій ({max_iterations}). Останні результати збережено."
+    # Системна інструкція та tools однакові для всіх ітерацій — великий префікс іде через cachedContents
+    prefix = {"tools": tools_declaration}
+    if system_prompt:
+        prefix["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+    prefix_bytes = json_size(prefix)
+    turn_bytes = [json_size(contents[0])]
+    conversation_cache = None  # одноразовий cachedContents з префіксом + contents[:cached_turns]
+    cached_turns = 0
+    roll_conversation = GEMINI_CACHE_CONVERSATION
+    # [turn, part, розмір, підсумок] ще не згорнутих functionResponse, від найстаріших
+    tool_responses = []
+
+    try:
+        for iteration in range(max_iterations):
+            # Ранні ходи вже не змінюються: коли їх назбиралось достатньо, кеш переноситься вперед.
+            # Межа — перед останнім ходом моделі, щоб хвіст запиту був (functionCall, functionResponse)
+            boundary = len(contents) - 2
+            if conversation_cache and not gemini_context_cache.alive(conversation_cache):
+                conversation_cache, cached_turns = None, 0
+            if roll_conversation and sum(turn_bytes[cached_turns:boundary]) >= GEMINI_CACHE_ROLL_CHARS:
+                rolled = await gemini_context_cache.get(
+                    model, headers, {**prefix, "contents": contents[:boundary]}, GEMINI_CONVERSATION_CACHE_TTL
+                )
+                # Gemini відмовив — до кінця циклу не пробуємо, бо кожна спроба вивантажує всю розмову
+                roll_conversation = rolled is not None
+                if rolled:
+                    if conversation_cache:
+                        await gemini_context_cache.delete(conversation_cache, headers)
+                    conversation_cache, cached_turns = rolled, boundary
+
+            if conversation_cache:
+                payload = {"contents": contents[cached_turns:], "cachedContent": conversation_cache}
+                inline = {**prefix, "contents": contents}
+            else:
+                cache_name = await gemini_context_cache.get(model, headers, prefix)
+                if cache_name:
+                    payload = {"contents": contents, "cachedContent": cache_name}
+                else:
+                    payload = {"contents": contents, **prefix}
+                inline = prefix
+            inline_bytes = prefix_bytes + sum(turn_bytes)
+            request_bytes = sum(turn_bytes[cached_turns:]) + (
+                json_size(payload["cachedContent"]) if "cachedContent" in payload else prefix_bytes
+            )
+
+            print(f"[agentic_loop] Iteration {iteration + 1}/{max_iterations}")
+            started = time.perf_counter()
+            try:
+                data = await _gemini_api_call(model, headers, payload, inline)
+            except Exception as api_err:
+                print(f"[agentic_loop] Gemini API call failed: {api_err}")
+                raise
+            record_loop_usage(
+                usage_log, iteration + 1, request_bytes, inline_bytes, cached_turns,
+                data, time.perf_counter() - started
+            )
+
+            candidates = data.get("candidates", [])
+            if not candidates:
+                prompt_feedback = data.get("promptFeedback", {})
+                block_reason = prompt_feedback.get("blockReason", "UNKNOWN")
+                print(f"[agentic_loop] Empty candidates! blockReason={block_reason}, raw={json.dumps(data)[:300]}")
+                break
+
+            candidate = candidates[0]
+            content = candidate.get("content", {})
+            parts = content.get("parts", [])
+            finish_reason = candidate.get("finishReason", "STOP")
+
+            print(f"[agentic_loop] finishReason={finish_reason}, parts_count={len(parts)}")
+
+            function_calls = [p["functionCall"] for p in parts if "functionCall" in p]
+
+            if not function_calls:
+                final_text = "".join(p.get("text", "") for p in parts)
+                print(f"[agentic_loop] Final text response ({len(final_text)} chars)")
+                break
+
+            contents.append({"role": "model", "parts": parts})
+            turn_bytes.append(json_size(contents[-1]))
+
+            for fc in function_calls:
+                fc_args = fc.get("args", {})
+                queries_executed.append(fc_args.get("query", ""))
+                if fc_args.get("graphs"):
+                    graphs_searched.update(fc_args["graphs"])
+
+            # Виклики одного ходу виконуються паралельно; gather зберігає порядок functionResponse
+            function_responses = await asyncio.gather(*(run_call(fc) for fc in function_calls))
+
+            contents.append({"role": "user", "parts": function_responses})
+            turn_bytes.append(json_size(contents[-1]))
+
+            for i, (fc, response) in enumerate(zip(function_calls, function_responses)):
+                result_text = response["functionResponse"]["response"]["result"]
+                tool_responses.append([
+                    len(contents) - 1, i, len(result_text),
+                    summarise_tool_result(fc.get("args", {}).get("query", ""), result_text)
+                ])
+
+            # Понад бюджет розмови згортаємо найстаріші відповіді до 3/4 бюджету (щоб не згортати
+            # по одній на кожному ході); відповіді останнього ходу лишаються повними
+            collapsed = set()
+            if sum(entry[2] for entry in tool_responses) > AGENT_CONTEXT_MAX_CHARS:
+                low_water = AGENT_CONTEXT_MAX_CHARS * 3 // 4
+                while sum(entry[2] for entry in tool_responses) > low_water and tool_responses[0][0] < len(contents) - 1:
+                    turn, part, _, summary = tool_responses.pop(0)
+                    contents[turn]["parts"][part]["functionResponse"]["response"]["result"] = summary
+                    collapsed.add(turn)
+            if collapsed:
+                for turn in collapsed:
+                    turn_bytes[turn] = json_size(contents[turn])
+                print(f"[agentic_loop] Collapsed older tool results in turns {sorted(collapsed)} to stay within {AGENT_CONTEXT_MAX_CHARS} chars")
+                # Закешований префікс розмови більше не збігається з contents
+                if conversation_cache and min(collapsed) < cached_turns:
+                    await gemini_context_cache.delete(conversation_cache, headers)
+                    conversation_cache, cached_turns = None, 0
+        else:
+            final_text = f"Досягнуто ліміт ітерацій ({max_iterations}). Останні результати збережено."
+    finally:
+        if conversation_cache:
+            await gemini_context_cache.delete(conversation_cache, headers)
 
     return final_text, queries_executed, list(graphs_searched)
 
 
 async def agent_task_wrapper(task_id: str, prompt: str, system_prompt: str, model: str):
     """Background wrapper that executes the LLM task via a thread and manages state."""
-    from mcp.client.sse import sse_client
-    from mcp.client.session import ClientSession
-    
     current_task_id.set(task_id)
-    state = TaskManager[task_id]
+    state = TaskManager.get(task_id)
     try:
         print(f"--- [Task {task_id}] Execution Started ---")
         
-        server_url = "http://grynya-mcp-server:8000/sse"
-        print(f"[{task_id}] Connecting to MCP server at {server_url}...")
+        tools = await graph_backend.list_tools()
+        tool_names = [t.name for t in tools]
+        print(f"[{task_id}] Discovered tools: {tool_names}")
+        print(f"[{task_id}] Бачу базу та інструменти, полет нормальний.")
+
+        # Direct write to the graph (Phase 3)
+        import datetime
+        now = datetime.datetime.now(datetime.timezone.utc)
+        day_id_str = "d_" + now.strftime("%Y_%m_%d")
         
-        async with sse_client(server_url, headers={"Host": "localhost"}) as streams:
-            print(f"[{task_id}] SSE connection established.")
-            async with ClientSession(streams[0], streams[1]) as session:
-                await session.initialize()
-                print(f"[{task_id}] MCP Session initialized.")
-                
-                tools_response = await session.list_tools()
-                tool_names = [t.name for t in tools_response.tools]
-                print(f"[{task_id}] Discovered tools: {tool_names}")
-                print(f"[{task_id}] Бачу базу та інструменти, полет нормальний.")
-
-                # Direct write to the graph (Phase 3)
-                import datetime
-                now = datetime.datetime.now(datetime.timezone.utc)
-                day_id_str = "d_" + now.strftime("%Y_%m_%d")
-                
-                print(f"[{task_id}] Writing progress to FalkorDB directly via grynya-mcp-server...")
-                try:
-                    save_res = await session.call_tool("add_node", arguments={
-                        "node_type": "Analysis",
-                        "node_data": {
-                            "id": f"klim_progress_{task_id}",
-                            "full_text": f"[Status Update from Klim] Task ID: {task_id}. Proceeding with model {model}.",
-                            "time": now.isoformat()
-                        },
-                        "day_id": day_id_str
-                    })
-                    print(f"[{task_id}] Graph save response: {save_res}")
-                except Exception as e:
-                    print(f"[{task_id}] Failed to save to graph: {e}")
+        print(f"[{task_id}] Writing progress to FalkorDB directly via grynya-mcp-server...")
+        try:
+            save_res = await graph_backend.call_tool("add_node", arguments={
+                "node_type": "Analysis",
+                "node_data": {
+                    "id": f"klim_progress_{task_id}",
+                    "full_text": f"[Status Update from Klim] Task ID: {task_id}. Proceeding with model {model}.",
+                    "time": now.isoformat()
+                },
+                "day_id": day_id_str
+            })
+            print(f"[{task_id}] Graph save response: {save_res}")
+        except Exception as e:
+            print(f"[{task_id}] Failed to save to graph: {e}")
 
-        
-        # Execute blocking calls off the main event loop
+        # LLM calls share one keep-alive async HTTP client
         model_lower = model.lower()
         if "gemini" in model_lower:
-            result = await asyncio.to_thread(call_gemini, prompt, system_prompt, model)
+            result = await call_gemini(prompt, system_prompt, model, on_delta=state.append_partial)
         elif "gpt" in model_lower or "o1" in model_lower or "o3" in model_lower:
-            result = await asyncio.to_thread(call_openai, prompt, system_prompt, model)
+            result = await call_openai(prompt, system_prompt, model, on_delta=state.append_partial)
         else:
             result = f"Error: Unsupported model identifier '{model}'. Must contain 'gemini', 'gpt', 'o1' or 'o3'."
             
-        state.result = f"{result}\n\n[Автономний агент рапортує: Бачу базу та інструменти, полет нормальний.]"
-        state.status = "completed"
+        state.finish("completed", result=f"{result}\n\n[Автономний агент рапортує: Бачу базу та інструменти, полет нормальний.]")
         print(f"--- [Task {task_id}] Execution Completed ---")
     except asyncio.CancelledError:
         print(f"--- [Task {task_id}] Execution Cancelled ---")
-        state.status = "cancelled"
-        state.error = "Cancelled by user"
+        state.finish("cancelled", error="Cancelled by user")
     except Exception as e:
         import traceback
         error_msg = traceback.format_exc()
         print(f"--- [Task {task_id}] Execution Failed ---")
         print(error_msg)
-        state.status = "failed"
-        state.error = str(e)
+        state.finish("failed", error=str(e))
 
 @mcp.tool()
 async def run_agent_task(prompt: str, system_prompt: str = None, model: str = "gemini-2.5-flash") -> str:
     """
     [БЛОКУЄ] Запускає задачу агента синхронно через вказаного LLM провайдера.
-    Примітка: Блокує event loop сервера FastMCP при інтенсивному використанні.
+    Виклик чекає на відповідь моделі, але event loop сервера FastMCP не блокує.
     """
     print(f"[run_agent_task] Received request for model: {model}")
     
     # Discovery tools from grynya-mcp-server
     tools_info = "No database tools discovered."
-    from mcp.client.sse import sse_client
-    from mcp.client.session import ClientSession
-    
-    server_url = "http://grynya-mcp-server:8000/sse"
     try:
-        async with sse_client(server_url, headers={"Host": "localhost"}) as streams:
-            async with ClientSession(streams[0], streams[1]) as session:
-                await session.initialize()
-                tools_response = await session.list_tools()
-                tools_list = []
-                for t in tools_response.tools:
-                    tools_list.append(f"Tool: {t.name}, Description: {t.description}")
-                tools_info = "\n".join(tools_list)
-                print(f"[run_agent_task] Discovered {len(tools_response.tools)} database tools.")
+        tools = await graph_backend.list_tools()
+        tools_list = []
+        for t in tools:
+            tools_list.append(f"Tool: {t.name}, Description: {t.description}")
+        tools_info = "\n".join(tools_list)
+        print(f"[run_agent_task] Discovered {len(tools)} database tools.")
     except Exception as e:
         print(f"[run_agent_task] Failed to discover tools: {e}")
 
     model_lower = model.lower()
     if "gemini" in model_lower:
-        return await asyncio.to_thread(call_gemini, prompt, system_prompt, model, tools_info)
+        return await call_gemini(prompt, system_prompt, model, tools_info)
     elif "gpt" in model_lower or "o1" in model_lower or "o3" in model_lower:
         # OpenAI doesn't get tools metadata yet in this simple wrapper
-        return await asyncio.to_thread(call_openai, prompt, system_prompt, model)
+        return await call_openai(prompt, system_prompt, model)
     else:
         return f"Error: Unsupported model identifier '{model}'."
 
 @mcp.tool()
-async def start_async_agent_task(prompt: str, system_prompt: str = None, model: str = "gemini-2.5-flash") -> str:
+async def start_async_agent_task(prompt: str, system_prompt: str = None, model: str = "gemini-2.5-flash", priority: int = 0) -> str:
     """
     Запускає асинхронну задачу агента у фоновому режимі. 
     Повертає task_id негайно без блокування.
+    Якщо ліміт одночасних задач для моделі/провайдера вичерпано, задача отримує статус "queued"
+    і стартує, щойно звільниться слот; більший priority — раніше в черзі.
     Використовуйте `check_task_status(task_id)` для отримання логів та результатів.
     """
     import uuid
     task_id = str(uuid.uuid4())
     state = TaskState(id=task_id, status="running")
-    TaskManager[task_id] = state
+    TaskManager.add(state)
     
-    # create background task without blocking
-    task_obj = asyncio.create_task(agent_task_wrapper(task_id, prompt, system_prompt, model))
-    state.task_obj = task_obj
+    # create background task without blocking (or queue it)
+    scheduler.submit(state, model, priority, lambda: agent_task_wrapper(task_id, prompt, system_prompt, model))
     
-    return json.dumps({
+    response = {
         "status": "success",
         "task_id": task_id,
+        "task_status": state.status,
         "message": "Task started asynchronously in the background."
-    })
+    }
+    if state.status == "queued":
+        response["queue_position"] = scheduler.queue_position(state)
+        response["message"] = "Task queued: concurrency limit reached for this model."
+    return json.dumps(response)
 
 @mcp.tool()
 def cancel_agent_task(task_id: str) -> str:
     """
-    Скасовує асинхронну задачу агента, яка виконується у фоновому режимі.
+    Скасовує асинхронну задачу агента, яка виконується у фоновому режимі або чекає в черзі.
     """
-    if task_id not in TaskManager:
+    state = TaskManager.get(task_id)
+    if state is None:
         return json.dumps({"status": "error", "message": f"Task {task_id} not found."})
-        
-    state = TaskManager[task_id]
     
-    if state.status == "running":
+    if state.status == "queued":
+        if scheduler.cancel_queued(state):
+            return json.dumps({"status": "success", "message": f"Queued task {task_id} has been cancelled."})
+        return json.dumps({"status": "error", "message": f"Task {task_id} is not in the queue."})
+    elif state.status == "running":
         if state.task_obj and not state.task_obj.done():
             state.task_obj.cancel()
             return json.dumps({"status": "success", "message": f"Task {task_id} has been cancelled."})
@@ -472,122 +1907,279 @@ def cancel_agent_task(task_id: str) -> str:
     else:
         return json.dumps({"status": "error", "message": f"Task {task_id} is not running (current status: {state.status})."})
 
+RESEARCH_CACHE_SIZE = int(os.environ.get("RESEARCH_CACHE_SIZE", "256"))
+RESEARCH_CACHE_TTL = float(os.environ.get("RESEARCH_CACHE_TTL", "86400"))
+
+def normalise_research_query(query: str) -> str:
+    """Регістр, зайві пробіли та кінцева пунктуація не роблять запит новим."""
+    return " ".join(query.casefold().split()).strip(" .?!…")
+
+async def fetch_graph_versions(graphs: list):
+    """
+    Лічильники змін графів з grynya-сервісу (graph_versions): (versions, default_graph)
+    або (None, None), якщо сервіс їх не підтримує.
+    """
+    try:
+        data = json.loads(await graph_backend.call_tool("graph_versions", arguments={"graphs": graphs}))
+    except Exception as e:
+        print(f"[research_cache] graph_versions unavailable: {e}")
+        return None, None
+    if data.get("status") != "success":
+        print(f"[research_cache] graph_versions failed: {data.get('message')}")
+        return None, None
+    return data["versions"], data.get("default_graph")
+
+class ResearchCache:
+    """
+    Мемоізація research_graph. Ключ — (нормалізований запит, графи, скіл, модель);
+    звіт дійсний, поки лічильники змін цих графів (graph_versions) ті самі, що при збереженні.
+    Індекс у пам'яті (LRU + TTL); при промаху звіт шукається серед вузлів :Research
+    за cache_key і cache_versions, тож кеш переживає перезапуск провайдера.
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple] = OrderedDict()  # key -> (versions_json, report, stored_at)
+        self.hits = 0
+        self.graph_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(user_query: str, graphs: list, skill_name: str, model: str) -> str:
+        raw = json.dumps([normalise_research_query(user_query), sorted(graphs), skill_name, normalise_model(model)])
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    @staticmethod
+    def encode_versions(versions: dict) -> str:
+        return json.dumps(versions, sort_keys=True)
+
+    def put(self, key: str, versions: dict, report: dict):
+        self._entries[key] = (self.encode_versions(versions), report, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def lookup(self, key: str, versions: dict):
+        """Звіт для ключа при незмінних графах або None."""
+        encoded = self.encode_versions(versions)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == encoded and time.monotonic() - entry[2] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        query = (
+            f"MATCH (r:Research {{cache_key: {json.dumps(key)}, cache_versions: {json.dumps(encoded)}}}) "
+            "RETURN r.id AS id, r.summary AS summary, r.graphs_searched AS graphs_searched, "
+            "r.cypher_queries AS cypher_queries, r.source_node_ids AS source_node_ids, r.is_empty AS is_empty "
+            "ORDER BY r.time DESC LIMIT 1"
+        )
+        try:
+            data = json.loads(await graph_backend.call_tool("query_graph", arguments={"query": query}))
+            row = data["results"][0] if data.get("status") == "success" and data.get("results") else None
+        except Exception as e:
+            print(f"[research_cache] :Research lookup failed: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+
+        report = {
+            "status": "success",
+            "research_node_id": row["id"],
+            "summary": row["summary"],
+            "graphs_searched": json.loads(row["graphs_searched"] or "[]"),
+            "queries_executed_count": len(json.loads(row["cypher_queries"] or "[]")),
+            "source_nodes_found": len(json.loads(row["source_node_ids"] or "[]")),
+            # Властивості вузла приходять рядками ("True"/"False")
+            "is_empty": row["is_empty"] in (True, "True", "true")
+        }
+        self.put(key, versions, report)
+        self.graph_hits += 1
+        return report
+
+    async def store(self, research_id: str, key: str, graphs: list, report: dict):
+        """
+        Прив'язує щойно збережений :Research до поточних лічильників графів.
+        Запис cache_versions сам змінює граф за замовчуванням, тому його лічильник
+        зберігається вже з урахуванням цього запису. Викликається лише тоді, коли
+        лічильники перед записом :Research збігаються зі знімком до агентного циклу
+        (інакше звіт міг пропустити чужі записи); паралельний запис іншого клієнта
+        після цієї перевірки лише зробить звіт недійсним.
+        """
+        versions, default_graph = await fetch_graph_versions(graphs)
+        if versions is None:
+            return
+        if default_graph in versions:
+            versions[default_graph] += 1
+        query = (
+            f"MATCH (r:Research {{id: {json.dumps(research_id)}}}) "
+            f"SET r.cache_versions = {json.dumps(self.encode_versions(versions))} "
+            f"RETURN r.id"
+        )
+        try:
+            data = json.loads(await graph_backend.call_tool("query_graph", arguments={"query": query}))
+        except Exception as e:
+            print(f"[research_cache] Failed to store cache_versions: {e}")
+            return
+        if data.get("status") != "success":
+            print(f"[research_cache] Failed to store cache_versions: {data.get('message')}")
+            return
+        if not data.get("results"):
+            print(f"[research_cache] :Research node {research_id} not found, report not cached")
+            return
+        self.put(key, versions, report)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "graph_hits": self.graph_hits,
+            "misses": self.misses
+        }
+
+research_cache = ResearchCache(RESEARCH_CACHE_SIZE, RESEARCH_CACHE_TTL)
+
 @mcp.tool()
 async def research_graph(
     user_query: str,
     graphs: list = None,
     model: str = "gemini-2.5-flash",
-    skill_name: str = "graph-research"
+    skill_name: str = "graph-research",
+    refresh: bool = False
 ) -> str:
     """
     Досліджує граф(и) FalkorDB за запитом користувача через Klim (Gemini Function Calling).
     Klim самостійно формує та виконує Cypher запити в агентному циклі.
     Зберігає вузол :Research в граф та повертає node_id + summary.
+    Повторний (чи той самий з точністю до регістру/пробілів) запит до незмінених графів
+    повертає попередній звіт без нового циклу ("cached": true), див. ResearchCache.
 
     user_query: запит/тема для дослідження (зазвичай перший запит користувача в сесії)
     graphs: список графів для пошуку (наприклад ['Grynya', 'Cursa4']). За замовчуванням — ['Grynya'].
     model: модель Gemini для використання (default: gemini-2.5-flash)
     skill_name: назва скілу в .gemini/antigravity/skills/<skill_name>/SKILL.md (default: graph-research)
+    refresh: True — ігнорувати збережений звіт і дослідити заново
     """
-    from mcp.client.sse import sse_client
-    from mcp.client.session import ClientSession
     import datetime
 
-    server_url = "http://grynya-mcp-server:8000/sse"
     print(f"[research_graph] Starting research for query: {user_query[:80]}...")
     print(f"[research_graph] Target graphs: {graphs}, skill: {skill_name}")
 
     skill_prompt = load_skill(skill_name)
 
     try:
-        async with sse_client(server_url, headers={"Host": "localhost"}) as streams:
-            async with ClientSession(streams[0], streams[1]) as session:
-                await session.initialize()
-                print("[research_graph] FalkorDB session initialized.")
-
-                graphs_to_search = graphs if graphs else ["Grynya"]
-                search_prompt = (
-                    f"Search graphs {graphs_to_search} for information relevant to this query:\n"
-                    f"«{user_query}»\n\n"
-                    f"Follow the instructions in your system prompt. Return valid JSON."
-                )
+        graphs_to_search = graphs if graphs else ["Grynya"]
+        cache_key = ResearchCache.key(user_query, graphs_to_search, skill_name, model)
+        # Знімок лічильників до циклу: звіт кешується, лише якщо графи не змінились, поки він складався
+        versions, _ = await fetch_graph_versions(graphs_to_search)
+        if not refresh and versions is not None:
+            cached = await research_cache.lookup(cache_key, versions)
+            if cached is not None:
+                print(f"[research_graph] Returning cached report {cached['research_node_id']} (graphs unchanged)")
+                return json.dumps({**cached, "cached": True})
+
+        usage_log = []
+        search_prompt = (
+            f"Search graphs {graphs_to_search} for information relevant to this query:\n"
+            f"«{user_query}»\n\n"
+            f"Follow the instructions in your system prompt. Return valid JSON."
+        )
 
-                final_text, queries_executed, graphs_searched = await call_gemini_agentic_loop(
-                    prompt=search_prompt,
-                    system_prompt=skill_prompt,
-                    model=model,
-                    falkordb_session=session
-                )
+        final_text, queries_executed, graphs_searched = await call_gemini_agentic_loop(
+            prompt=search_prompt,
+            system_prompt=skill_prompt,
+            model=model,
+            graph_backend=graph_backend,
+            usage_log=usage_log
+        )
 
-                if not graphs_searched:
-                    graphs_searched = graphs_to_search
-
-                now = datetime.datetime.now(datetime.timezone.utc)
-                research_id = f"research_{now.strftime('%Y%m%d_%H%M%S')}"
-                day_id = f"d_{now.strftime('%Y_%m_%d')}"
-
-                def _strip_markdown_json(text: str) -> str:
-                    """Видаляє ```json ... ``` або ``` ... ``` обгортку якщо є."""
-                    text = text.strip()
-                    if text.startswith("```"):
-                        lines = text.split("\n")
-                        # Відкидаємо перший рядок (```json або ```) і останній (```)
-                        inner = lines[1:] if lines[-1].strip() == "```" else lines[1:]
-                        if inner and inner[-1].strip() == "```":
-                            inner = inner[:-1]
-                        text = "\n".join(inner).strip()
-                    return text
-
-                clean_text = _strip_markdown_json(final_text) if final_text else ""
-                try:
-                    report_data = json.loads(clean_text)
-                    summary = report_data.get("summary", clean_text[:300])
-                    found_nodes = report_data.get("found_nodes", [])
-                    source_node_ids = [n["id"] for n in found_nodes if "id" in n]
-                    is_empty = report_data.get("is_empty", not bool(found_nodes))
-                except (json.JSONDecodeError, TypeError):
-                    summary = clean_text[:500] if clean_text else "Дослідження завершено, результати відсутні."
-                    source_node_ids = []
-                    is_empty = not bool(clean_text)
-
-                node_data = {
-                    "id": research_id,
-                    "name": f"Research: {user_query[:60]}",
-                    "query": user_query,
-                    "summary": summary,
-                    "full_report": final_text[:4000] if final_text else "",
-                    "cypher_queries": json.dumps(queries_executed),
-                    "graphs_searched": json.dumps(graphs_searched),
-                    "source_node_ids": json.dumps(source_node_ids),
-                    "is_empty": is_empty,
-                    "time": now.isoformat()
-                }
+        if not graphs_searched:
+            graphs_searched = graphs_to_search
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        research_id = f"research_{now.strftime('%Y%m%d_%H%M%S')}"
+        day_id = f"d_{now.strftime('%Y_%m_%d')}"
+
+        def _strip_markdown_json(text: str) -> str:
+            """Видаляє ```json ... ``` або ``` ... ``` обгортку якщо є."""
+            text = text.strip()
+            if text.startswith("```"):
+                lines = text.split("\n")
+                # Відкидаємо перший рядок (```json або ```) і останній (```)
+                inner = lines[1:] if lines[-1].strip() == "```" else lines[1:]
+                if inner and inner[-1].strip() == "```":
+                    inner = inner[:-1]
+                text = "\n".join(inner).strip()
+            return text
 
-                save_result = await session.call_tool("add_node", arguments={
-                    "node_type": "Research",
-                    "node_data": node_data,
-                    "day_id": day_id,
-                    "time": now.strftime("%H:%M:%S")
-                })
-                print(f"[research_graph] :Research node saved: {research_id}")
-
-                if source_node_ids:
-                    links = [
-                        {"source_id": research_id, "target_id": nid, "type": "SOURCED_FROM"}
-                        for nid in source_node_ids[:20]
-                    ]
-                    await session.call_tool("batch_link_nodes", arguments={"links": links})
-                    print(f"[research_graph] Linked {len(links)} source nodes.")
-
-                return json.dumps({
-                    "status": "success",
-                    "research_node_id": research_id,
-                    "summary": summary,
-                    "graphs_searched": graphs_searched,
-                    "queries_executed_count": len(queries_executed),
-                    "source_nodes_found": len(source_node_ids),
-                    "is_empty": is_empty
-                })
+        clean_text = _strip_markdown_json(final_text) if final_text else ""
+        try:
+            report_data = json.loads(clean_text)
+            summary = report_data.get("summary", clean_text[:300])
+            found_nodes = report_data.get("found_nodes", [])
+            source_node_ids = [n["id"] for n in found_nodes if "id" in n]
+            is_empty = report_data.get("is_empty", not bool(found_nodes))
+        except (json.JSONDecodeError, TypeError):
+            summary = clean_text[:500] if clean_text else "Дослідження завершено, результати відсутні."
+            source_node_ids = []
+            is_empty = not bool(clean_text)
+
+        node_data = {
+            "id": research_id,
+            "name": f"Research: {user_query[:60]}",
+            "query": user_query,
+            "summary": summary,
+            "full_report": final_text[:4000] if final_text else "",
+            "cypher_queries": json.dumps(queries_executed),
+            "graphs_searched": json.dumps(graphs_searched),
+            "source_node_ids": json.dumps(source_node_ids),
+            "is_empty": is_empty,
+            "time": now.isoformat(),
+            "cache_key": cache_key
+        }
+
+        versions_before_save, _ = await fetch_graph_versions(graphs_to_search)
+        cacheable = versions is not None and versions_before_save == versions
+        if not cacheable:
+            print("[research_graph] Graphs changed during research, report will not be cached")
+
+        save_result = await graph_backend.call_tool("add_node", arguments={
+            "node_type": "Research",
+            "node_data": node_data,
+            "day_id": day_id,
+            "time": now.strftime("%H:%M:%S")
+        })
+        try:
+            save_data = json.loads(save_result)
+            node_saved = save_data.get("status") == "success" and save_data["results"][0].get("status") == "success"
+        except (json.JSONDecodeError, TypeError, KeyError, IndexError, AttributeError):
+            node_saved = False
+        if node_saved:
+            print(f"[research_graph] :Research node saved: {research_id}")
+        else:
+            print(f"[research_graph] Failed to save :Research node {research_id}: {save_result[:300]}")
+
+        if source_node_ids and node_saved:
+            links = [
+                {"source_id": research_id, "target_id": nid, "type": "SOURCED_FROM"}
+                for nid in source_node_ids[:20]
+            ]
+            await graph_backend.call_tool("batch_link_nodes", arguments={"links": links})
+            print(f"[research_graph] Linked {len(links)} source nodes.")
+
+        report = {
+            "status": "success",
+            "research_node_id": research_id,
+            "summary": summary,
+            "graphs_searched": graphs_searched,
+            "queries_executed_count": len(queries_executed),
+            "source_nodes_found": len(source_node_ids),
+            "is_empty": is_empty
+        }
+        if node_saved and cacheable:
+            await research_cache.store(research_id, cache_key, graphs_to_search, report)
+        return json.dumps({**report, "usage": summarise_loop_usage(usage_log)})
 
     except Exception as e:
         import traceback
@@ -596,35 +2188,140 @@ async def research_graph(
         return json.dumps({"status": "error", "message": str(e)})
 
 
-@mcp.tool()
-def check_task_status(task_id: str) -> str:
-    """
-    Перевіряє статус, логи та потенційний результат/помилку асинхронної задачі.
-    """
-    if task_id not in TaskManager:
-        return json.dumps({"status": "error", "message": f"Task {task_id} not found."})
-        
-    state = TaskManager[task_id]
-    
-    with log_lock:
-        logs = "".join(state.logs_buffer)
+def task_status_payload(state: TaskState, since_offset: int = 0, since_seq: int = 0) -> dict:
+    lines, next_seq, dropped = state.logs_since(since_seq)
     
     response = {
         "task_id": state.id,
         "status": state.status,
-        "logs": logs
+        "logs": "".join(lines),
+        "next_seq": next_seq
     }
+    if dropped:
+        response["logs_dropped"] = dropped
+    if state.status == "queued":
+        response["queue_position"] = scheduler.queue_position(state)
     
+    if state.partial_len:
+        response["partial_result"], response["partial_offset"] = state.partial_since(since_offset)
     if state.result is not None:
         response["result"] = state.result
     if state.error is not None:
         response["error"] = state.error
+    return response
+
+@mcp.tool()
+def list_skills() -> str:
+    """
+    Перелік скілів з .gemini/antigravity/skills/: назва, опис із frontmatter,
+    розмір тіла та час зміни SKILL.md. Змінені файли перечитуються автоматично.
+    """
+    skills = skill_registry.load_all()
+    return json.dumps({
+        "status": "success",
+        "skills": [{
+            "name": skill.name,
+            "description": skill.meta.get("description", ""),
+            "meta": skill.meta,
+            "body_chars": len(skill.body),
+            "modified": skill.mtime_ns / 1e9
+        } for skill in skills],
+        "registry": skill_registry.stats()
+    }, ensure_ascii=False)
+
+@mcp.tool()
+def check_task_status(task_id: str, since_offset: int = 0, since_seq: int = 0) -> str:
+    """
+    Перевіряє статус, логи та потенційний результат/помилку асинхронної задачі.
+    logs містить лише рядки з номером >= since_seq; next_seq — since_seq для наступного опитування,
+    logs_dropped — скільки запитаних рядків уже витіснено з кільцевого буфера.
+    Поки модель відповідає потоково, partial_result містить текст, що вже надійшов,
+    починаючи з since_offset; partial_offset — значення since_offset для наступного опитування.
+    """
+    state = TaskManager.get(task_id)
+    if state is None:
+        return json.dumps({"status": "error", "message": f"Task {task_id} not found."})
         
+    return json.dumps(task_status_payload(state, since_offset, since_seq))
+
+TASK_WAIT_MAX = float(os.environ.get("TASK_WAIT_MAX", "300"))
+
+@mcp.tool()
+async def wait_task(task_id: str, timeout: float = 30, since_offset: int = 0, since_seq: int = 0, ctx: Context = None) -> str:
+    """
+    Чекає завершення асинхронної задачі до timeout секунд (не більше TASK_WAIT_MAX)
+    і повертає те саме, що check_task_status, плюс timed_out.
+    Поки задача виконується, надсилає MCP progress-нотифікації з останнім рядком логу,
+    якщо клієнт передав progressToken.
+    """
+    state = TaskManager.get(task_id)
+    if state is None:
+        return json.dumps({"status": "error", "message": f"Task {task_id} not found."})
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + min(max(timeout, 0), TASK_WAIT_MAX)
+    reported = None
+    while True:
+        # Беремо changed до перевірки стану, щоб не пропустити сигнал між ними
+        changed = state.changed
+        if state.finished_at is not None:
+            break
+        progress = state.log_seq + state.partial_len
+        if ctx is not None and progress != reported:
+            reported = progress
+            lines, _, _ = state.logs_since(state.log_seq - 1)
+            message = lines[-1].strip()[:200] if lines else state.status
+            if state.partial_len:
+                message += f" | partial_result: {state.partial_len} chars"
+            await ctx.report_progress(progress, message=message)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            await asyncio.wait_for(changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            break
+
+    response = task_status_payload(state, since_offset, since_seq)
+    response["timed_out"] = state.finished_at is None
     return json.dumps(response)
 
+@mcp.tool()
+def task_registry_stats() -> str:
+    """
+    Статистика реєстру задач: кількість, оцінка пам'яті, витіснення за TTL/LRU і на диск,
+    а також стан планувальника (слоти та черга).
+    """
+    return json.dumps({
+        "status": "success",
+        "registry": TaskManager.stats(),
+        "scheduler": scheduler.stats()
+    })
+
+@mcp.tool()
+def provider_stats() -> str:
+    """Лічильники підсистем провайдера, по секції на кожну."""
+    return json.dumps({
+        "status": "success",
+        "graph_backend": {
+            "name": graph_backend.name,
+            "pool": grynya_pool.stats() if graph_backend.name == "mcp" else None
+        },
+        "llm_retries": dict(
+            retry_stats,
+            rate_limit_waits=rate_limiter.waits,
+            rate_limit_wait_seconds=round(rate_limiter.wait_total, 3)
+        ),
+        "gemini_credentials": gemini_credentials.stats(),
+        "gemini_context_cache": gemini_context_cache.stats(),
+        "agent_loop": agent_loop_totals,
+        "research_cache": research_cache.stats(),
+        "skills": skill_registry.stats()
+    })
+
 if __name__ == "__main__":
     import sys
     if "--sse" in sys.argv:
-        mcp.run(transport="sse", host="0.0.0.0", port=8001)
+        asyncio.run(serve(transport="sse", host="0.0.0.0", port=8001))
     else:
-        mcp.run()
+        asyncio.run(serve())
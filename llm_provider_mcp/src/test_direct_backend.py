@@ -0,0 +1,59 @@
+import asyncio
+import json
+import os
+import sys
+import uuid
+
+# Smoke-тест GRAPH_BACKEND=direct: інструменти falkordb-service викликаються в цьому процесі.
+# Потрібен доступний FalkorDB (FALKORDB_HOST/FALKORDB_PORT) і код сервісу (GRYNYA_SERVICE_PATH).
+# Запуск: FALKORDB_HOST=localhost python src/test_direct_backend.py
+
+GRAPH = os.environ.setdefault("GRAPH_NAME", f"direct_smoke_{uuid.uuid4().hex[:8]}")
+
+async def main():
+    os.environ["GRAPH_BACKEND"] = "direct"
+    sys.path.insert(0, os.path.dirname(__file__))
+    import server
+
+    backend = server.graph_backend
+    assert backend.name == "direct", backend.name
+    await backend.start()
+    try:
+        tools = {t.name for t in await backend.list_tools()}
+        print(f"Loaded {len(tools)} tools from {backend.service_path}")
+        assert {"query_graph", "add_node", "graph_versions"} <= tools
+
+        saved = json.loads(await backend.call_tool("add_node", arguments={
+            "node_type": "Entity", "node_data": {"id": "smoke_1", "name": "first"}
+        }))
+        assert saved["status"] == "success", saved
+
+        read = lambda: backend.call_tool("query_graph", arguments={"query": "MATCH (n:Entity {id: 'smoke_1'}) RETURN n.name AS name"})
+        first = json.loads(await read())
+        print("read:", first["results"])
+        assert first["results"] == [{"name": "first"}]
+
+        # Запис "іншого процесу": окреме з'єднання, як у grynya-mcp-server, змінює граф і лічильник.
+        # Закешована відповідь не повинна пережити цей запис.
+        service = backend._module
+        other = service.create_db_client()
+        await other.execute_command("GRAPH.QUERY", GRAPH, "MATCH (n:Entity {id: 'smoke_1'}) SET n.name = 'second'")
+        await other.incr(service.GRAPH_VERSION_KEY + GRAPH)
+
+        second = json.loads(await read())
+        print("read after external write:", second["results"])
+        assert second["results"] == [{"name": "second"}], second
+
+        versions = json.loads(await backend.call_tool("graph_versions", arguments={"graphs": [GRAPH]}))
+        print("versions:", versions)
+        assert versions["versions"][GRAPH] >= 2
+
+        await other.execute_command("GRAPH.DELETE", GRAPH)
+        await other.delete(service.GRAPH_VERSION_KEY + GRAPH)
+        await other.aclose()
+        print("OK: direct backend reads, writes and sees external changes.")
+    finally:
+        await backend.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+# Локальний stub замість Gemini/OpenAI: рахує нові TCP-з'єднання від спільного HTTP-клієнта.
+# Запуск: python src/test_keepalive.py (мережа та реальні ключі не потрібні)
+
+ITERATIONS = 10
+
+class StubLLMServer:
+    def __init__(self):
+        self.connections = 0
+        self.requests = 0
+        self.gemini_calls = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode().split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", "0")))
+                self.requests += 1
+
+                path = request_line.split(" ")[1]
+                if "chat/completions" in path:
+                    body = {
+                        "id": "stub", "object": "chat.completion", "created": 0, "model": "gpt-stub",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": "ok"}}]
+                    }
+                else:
+                    self.gemini_calls += 1
+                    # Перші ITERATIONS-1 відповідей просять виклик інструмента, остання — фінальний текст
+                    if self.gemini_calls % ITERATIONS:
+                        parts = [{"functionCall": {"name": "query_graph", "args": {"query": "RETURN 1"}}}]
+                    else:
+                        parts = [{"text": "done"}]
+                    body = {"candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}]}
+
+                data = json.dumps(body).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+class StubGraphBackend:
+    async def call_tool(self, name, arguments=None):
+        return json.dumps({"status": "success", "results": [{"1": 1}]})
+
+async def main():
+    stub = StubLLMServer()
+    srv = await asyncio.start_server(stub.handle, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+
+    token = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({
+        "token": "stub", "refresh_token": "stub", "client_id": "stub", "client_secret": "stub",
+        "expiry": "2099-01-01T00:00:00Z"
+    }, token)
+    token.close()
+
+    os.environ["GEMINI_API_BASE"] = f"http://127.0.0.1:{port}/v1beta"
+    os.environ["GEMINI_TOKEN_PATH"] = token.name
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    sys.path.insert(0, os.path.dirname(__file__))
+    import server
+
+    try:
+        final_text, queries, _ = await server.call_gemini_agentic_loop(
+            "ping", "stub", "gemini-stub", StubGraphBackend(), max_iterations=ITERATIONS
+        )
+        print(f"Gemini loop: {stub.requests} requests, {stub.connections} new connections, final={final_text!r}")
+        assert stub.requests == ITERATIONS and len(queries) == ITERATIONS - 1
+
+        for _ in range(ITERATIONS):
+            await server.call_openai("ping", "stub", "gpt-stub")
+        print(f"+ {ITERATIONS} OpenAI calls: {stub.requests} requests, {stub.connections} new connections")
+
+        assert stub.connections == 1, f"expected one keep-alive connection, got {stub.connections}"
+        print("OK: all calls reused a single connection.")
+    finally:
+        await server.close_http_client()
+        srv.close()
+        os.unlink(token.name)
+
+if __name__ == "__main__":
+    asyncio.run(main())
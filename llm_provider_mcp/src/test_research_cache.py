@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import sys
+
+# Кеш research_graph без пам'яті: звіт має знайтися серед вузлів :Research.
+# Звіт, під час складання якого граф змінив інший клієнт, не кешується.
+# Графовий бекенд підмінено stub-ом, що повертає властивості рядками, як query_graph сервісу.
+# Запуск: python src/test_research_cache.py (FalkorDB і Gemini не потрібні)
+
+class ResearchNodesBackend:
+    name = "stub"
+
+    def __init__(self):
+        self.nodes = []
+        self.queries = []
+        self.versions = {"grynya": 7}
+
+    async def call_tool(self, name: str, arguments: dict = None) -> str:
+        if name == "graph_versions":
+            return json.dumps({"status": "success", "versions": dict(self.versions), "default_graph": "grynya"})
+        if name == "add_node":
+            self.versions["grynya"] += 1
+            self.nodes.append({"cache_versions": None, **arguments["node_data"]})
+            return json.dumps({"status": "success", "results": [{"query": "stub", "status": "success"}]})
+        if name == "batch_link_nodes":
+            self.versions["grynya"] += 1
+            return json.dumps({"status": "success", "results": []})
+        query = arguments["query"]
+        self.queries.append(query)
+        if " SET r.cache_versions" in query:
+            # SET на відсутньому вузлі успішний, але рядків не повертає
+            self.versions["grynya"] += 1
+            rows = [{"r.id": n["id"]} for n in self.nodes if f"{{id: {json.dumps(n['id'])}}}" in query]
+            return json.dumps({"status": "success", "results": rows})
+        rows = [
+            {k: v for k, v in node.items() if k not in ("cache_key", "cache_versions")}
+            for node in self.nodes
+            if f"cache_key: {json.dumps(node['cache_key'])}" in query
+            and f"cache_versions: {json.dumps(node['cache_versions'])}" in query
+        ]
+        return json.dumps({"status": "success", "results": rows[:1]})
+
+async def main():
+    sys.path.insert(0, os.path.dirname(__file__))
+    import server
+
+    backend = ResearchNodesBackend()
+    server.graph_backend = backend
+    cache = server.ResearchCache(max_entries=8, ttl=3600)
+
+    versions = {"grynya": 7, "devtest": 3}
+    for key, is_empty in (("k_full", "False"), ("k_empty", "True")):
+        backend.nodes.append({
+            "cache_key": key, "cache_versions": cache.encode_versions(versions),
+            "id": f"research_{key}", "summary": f"summary {key}",
+            "graphs_searched": json.dumps(["devtest"]),
+            "cypher_queries": json.dumps(["MATCH (n) RETURN n"]),
+            "source_node_ids": json.dumps(["a", "b"]),
+            "is_empty": is_empty
+        })
+
+    # 1. Запису в пам'яті немає — звіт відновлюється з вузла :Research
+    full = await cache.lookup("k_full", versions)
+    empty = await cache.lookup("k_empty", versions)
+    print("graph hit:", full)
+    assert full["research_node_id"] == "research_k_full" and full["source_nodes_found"] == 2
+    assert full["is_empty"] is False and empty["is_empty"] is True
+    assert cache.graph_hits == 2 and len(backend.queries) == 2
+
+    # 2. Повторний запит обслуговується з пам'яті без звернення до графа
+    again = await cache.lookup("k_empty", versions)
+    assert again["is_empty"] is True and cache.hits == 1 and len(backend.queries) == 2
+
+    # 3. Граф змінився — ні пам'ять, ні вузол зі старими лічильниками не підходять
+    assert await cache.lookup("k_full", dict(versions, devtest=4)) is None
+    assert cache.misses == 1
+
+    # 4. cache_versions не записано (вузла :Research немає) — звіт не кешується
+    await cache.store("research_missing", "k_missing", ["grynya"], {"status": "success"})
+    assert "k_missing" not in cache._entries
+    await cache.store("research_k_full", "k_stored", ["grynya"], {"status": "success"})
+    assert "k_stored" in cache._entries
+
+    # 5. research_graph: граф змінився під час агентного циклу — звіт не кешується
+    other_client_writes = False
+
+    async def fake_loop(prompt, system_prompt, model, graph_backend, usage_log=None, **kwargs):
+        if other_client_writes:
+            backend.versions["grynya"] += 1
+        return json.dumps({"summary": "s", "found_nodes": [{"id": "a"}]}), ["MATCH (n) RETURN n"], ["grynya"]
+
+    server.call_gemini_agentic_loop = fake_loop
+    server.load_skill = lambda name: ""
+    server.research_cache = server.ResearchCache(max_entries=8, ttl=3600)
+    research = server.research_graph.fn
+
+    other_client_writes = True
+    report = json.loads(await research(user_query="moved", graphs=["grynya"]))
+    assert report["status"] == "success" and not server.research_cache._entries
+    other_client_writes = False
+    again = json.loads(await research(user_query="moved", graphs=["grynya"]))
+    assert "cached" not in again and len(server.research_cache._entries) == 1
+
+    # 6. Граф не змінювався — наступний такий самий запит обслуговується з кешу
+    cached = json.loads(await research(user_query="moved", graphs=["grynya"]))
+    assert cached["cached"] is True and cached["research_node_id"] == again["research_node_id"]
+
+    print("Stats:", cache.stats())
+    print("OK: :Research nodes restore reports with boolean is_empty.")
+
+if __name__ == "__main__":
+    asyncio.run(main())
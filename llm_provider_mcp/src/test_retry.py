@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Локальний stub Gemini/OpenAI зі сценаріями 429/503: перевіряє повтори з backoff,
+# Retry-After, перехід на запасну модель, token bucket та вичерпання спроб.
+# Запуск: python src/test_retry.py (мережа та реальні ключі не потрібні)
+
+class ScriptedLLMServer:
+    def __init__(self):
+        self.script = {}
+        self.log = []
+
+    def set_script(self, key, statuses):
+        """statuses — послідовність відповідей: код або (код, Retry-After); далі 200."""
+        self.script[key] = list(statuses)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode().split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", "0")))
+
+                path = request_line.split(" ")[1]
+                if "chat/completions" in path:
+                    key = "openai"
+                else:
+                    key = path.split("/models/")[1].split(":")[0]
+                self.log.append((time.perf_counter(), key))
+
+                planned = self.script.get(key)
+                status = planned.pop(0) if planned else 200
+                retry_after = None
+                if isinstance(status, tuple):
+                    status, retry_after = status
+
+                if status != 200:
+                    body = {"error": {"code": status, "message": "scripted failure"}}
+                elif key == "openai":
+                    body = {
+                        "id": "stub", "object": "chat.completion", "created": 0, "model": "gpt-stub",
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": "openai ok"}}]
+                    }
+                else:
+                    body = {"candidates": [{"content": {"role": "model", "parts": [{"text": f"{key} ok"}]}}]}
+
+                data = json.dumps(body).encode()
+                extra = f"Retry-After: {retry_after}\r\n" if retry_after is not None else ""
+                writer.write(
+                    f"HTTP/1.1 {status} Scripted\r\nContent-Type: application/json\r\n{extra}"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def main():
+    stub = ScriptedLLMServer()
+    srv = await asyncio.start_server(stub.handle, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+
+    token = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump({
+        "token": "stub", "refresh_token": "stub", "client_id": "stub", "client_secret": "stub",
+        "expiry": "2099-01-01T00:00:00Z"
+    }, token)
+    token.close()
+
+    os.environ.update({
+        "GEMINI_API_BASE": f"http://127.0.0.1:{port}/v1beta",
+        "GEMINI_TOKEN_PATH": token.name,
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "LLM_STREAMING": "0",
+        "LLM_RETRY_ATTEMPTS": "4",
+        "LLM_RETRY_BASE_DELAY": "0.1",
+        "LLM_FALLBACK_MODELS": "gemini-pro-stub=gemini-lite-stub",
+        "LLM_FALLBACK_AFTER": "2",
+        "LLM_RATE_LIMITS": "gemini-bucket-stub=300/1",
+    })
+    sys.path.insert(0, os.path.dirname(__file__))
+    import server
+
+    try:
+        # 1. 429 з Retry-After, потім 503 — третя спроба успішна
+        stub.set_script("gemini-flash-stub", [(429, "0.5"), 503])
+        start = time.perf_counter()
+        text = await server.call_gemini("ping", None, "gemini-flash-stub")
+        elapsed = time.perf_counter() - start
+        print(f"429+503 -> {text!r} in {elapsed:.2f}s")
+        assert text == "gemini-flash-stub ok" and elapsed >= 0.5
+
+        # 2. Основна модель постійно 429 — після 2 невдач перехід на запасну
+        stub.log.clear()
+        stub.set_script("gemini-pro-stub", [429] * 10)
+        text = await server.call_gemini("ping", None, "gemini-pro-stub")
+        print(f"fallback -> {text!r}, requests: {[key for _, key in stub.log]}")
+        assert text == "gemini-lite-stub ok"
+
+        # 3. OpenAI: 429, 503, потім успіх
+        stub.set_script("openai", [(429, "0"), 503])
+        text = await server.call_openai("ping", None, "gpt-stub")
+        print(f"openai 429+503 -> {text!r}")
+        assert text == "openai ok"
+
+        # 4. Token bucket 300/хв (5/с) з burst 1: 6 запитів займають щонайменше 1с
+        start = time.perf_counter()
+        for _ in range(6):
+            await server.call_gemini("ping", None, "gemini-bucket-stub")
+        elapsed = time.perf_counter() - start
+        print(f"token bucket: 6 requests in {elapsed:.2f}s")
+        assert elapsed >= 0.95
+
+        # 5. Постійні 503 — після LLM_RETRY_ATTEMPTS спроб повертається помилка
+        stub.log.clear()
+        stub.set_script("gemini-down-stub", [503] * 10)
+        text = await server.call_gemini("ping", None, "gemini-down-stub")
+        print(f"exhausted after {len(stub.log)} requests -> {text[:60]!r}")
+        assert len(stub.log) == 4 and text.startswith("Gemini API Error")
+
+        print("Stats:", json.loads(server.provider_stats.fn() if hasattr(server.provider_stats, "fn")
+                                   else server.provider_stats())["llm_retries"])
+        print("OK: retry policy behaves as scripted.")
+    finally:
+        await server.close_http_client()
+        srv.close()
+        os.unlink(token.name)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+
+# Бюджет результату query_graph у агентному циклі: навіть один величезний рядок
+# не має потрапити у functionResponse повністю.
+# Запуск: python src/test_tool_budget.py (FalkorDB і Gemini не потрібні)
+
+MAX_CHARS = 20000
+
+def main():
+    sys.path.insert(0, os.path.dirname(__file__))
+    import server
+
+    # 1. Один рядок з довгою текстовою властивістю
+    row = {"n.id": "doc_1", "n.content": "x" * 100_000}
+    text = json.dumps({"status": "success", "results": [row]})
+    out = server.truncate_tool_result(text, MAX_CHARS)
+    print("single row:", len(text), "->", len(out))
+    assert len(out) <= MAX_CHARS
+    data = json.loads(out)
+    assert data["truncated"] is True and data["hint"] == server.RESULT_TRUNCATION_HINT
+    assert data["results"][0]["n.id"] == "doc_1" and data["returned_rows"] == 1
+
+    # 2. collect(n) — один рядок з великим списком вузлів
+    nodes = [{"id": f"n{i}", "text": "y" * 500} for i in range(400)]
+    text = json.dumps({"status": "success", "results": [{"collect(n)": nodes}]})
+    out = server.truncate_tool_result(text, MAX_CHARS)
+    print("collect:", len(text), "->", len(out))
+    assert len(out) <= MAX_CHARS
+    data = json.loads(out)
+    assert data["truncated"] is True
+    assert data["results"][0]["collect(n)"][-1].endswith("more items]")
+
+    # 3. Кілька графів, в одному з них — один величезний рядок
+    text = json.dumps({"status": "success", "results": {
+        "grynya": [{"n.id": "a", "n.content": "z" * 100_000}],
+        "devtest": [{"n.id": f"b{i}"} for i in range(5)]
+    }})
+    out = server.truncate_tool_result(text, MAX_CHARS)
+    print("multi-graph:", len(text), "->", len(out))
+    assert len(out) <= MAX_CHARS
+    data = json.loads(out)
+    assert data["truncated"] is True and data["hint"]
+    assert data["results"]["grynya"][0]["n.id"] == "a" and len(data["results"]["devtest"]) == 5
+
+    # 4. Не-JSON текст обрізається разом з підказкою в межах бюджету
+    out = server.truncate_tool_result("q" * 100_000, MAX_CHARS)
+    assert len(out) <= MAX_CHARS and out.endswith(server.RESULT_TRUNCATION_HINT)
+
+    # 5. Малий результат не змінюється
+    small = json.dumps({"status": "success", "results": [{"n.id": "c"}]})
+    assert server.truncate_tool_result(small, MAX_CHARS) == small
+    print("OK")
+
+if __name__ == "__main__":
+    main()
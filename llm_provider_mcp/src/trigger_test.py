@@ -31,23 +31,26 @@ async def main():
                 print("Failed to get task_id")
                 return
                 
-            # Poll status
+            # Long-poll через wait_task — відповідь приходить одразу після завершення задачі;
+            # забираємо лише нові рядки логів через since_seq
+            next_seq = 0
             while True:
-                status_res = await session.call_tool("check_task_status", {
-                    "task_id": task_id
+                status_res = await session.call_tool("wait_task", {
+                    "task_id": task_id,
+                    "timeout": 30,
+                    "since_seq": next_seq
                 })
                 
                 status_info = json.loads(status_res.content[0].text)
                 state = status_info.get("status")
+                next_seq = status_info.get("next_seq", next_seq)
                 
-                print(f"Status: {state} | Logs length: {len(status_info.get('logs', ''))}")
+                print(f"Status: {state} | New logs length: {len(status_info.get('logs', ''))} | next_seq: {next_seq}")
                 
                 if state in ["completed", "failed", "cancelled"]:
                     print("\nFinal State Data:")
                     print(json.dumps(status_info, indent=2, ensure_ascii=False))
                     break
-                    
-                await asyncio.sleep(2)
 
 if __name__ == "__main__":
     asyncio.run(main())